@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any
 import requests
 from f.main.Collector import Collector, ef, t
@@ -27,6 +28,16 @@ def main():
         ).text,
     )
     list_start = next(i for i, node in enumerate(md) if node["type"] == "heading" and node["children"][0]["raw"] == "Lexicons") # type: ignore
+    # the dev and app accounts are resolved concurrently up front, the resolve_author calls below then read them from the cache
+    account_links = []
+    for node in md[list_start + 1:]:
+        if node["type"] == "list":
+            for field in node["children"]:
+                block = field['children'][0]['children']
+                if block[0]["raw"].startswith('Devs') or block[0]["raw"].lower().startswith('bluesky account'):
+                    account_links += [elem["attrs"]["url"] for elem in block[1:] if elem["type"] == "link"]
+    asyncio.run(c.g.resolve_identities(account_links))
+
     lexicons_entries = {}
     lex_name = ""
     for node in md[list_start + 1:]:
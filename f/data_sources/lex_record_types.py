@@ -1,5 +1,6 @@
 # ruff: noqa: E402 
 import asyncio
+from operator import itemgetter
 from typing import Any, Literal, Optional, TypedDict, cast
 from atproto_client.exceptions import AtProtocolError
 from pydantic import ValidationError
@@ -223,11 +224,12 @@ async def _main():
     #blocked this is a dirty hack because we have no way atm to tell current from outdated lexicons so we put the more 'authoritative' (bsky.app) repo first
     seen = {}
     diffs = {}
-    lex_domains: dict[str, dict[str, Any]] = {rec['domain']: rec for rec in g.list_records("Lexicons", sort='manualSort')[1]}
+    by_manual_sort = itemgetter("manualSort")
+    lex_domains: dict[str, dict[str, Any]] = {rec['domain']: rec for rec in sorted(g.read_table("Lexicons", hidden=True), key=by_manual_sort)}
     log.debug('fetched records')
     nsids: dict[str, dict[str, Any]] = {
         rec["nsid"]: rec
-        for rec in g.list_records("Tags_lexicon_record_types", sort="manualSort")[1]
+        for rec in sorted(g.read_table("Tags_lexicon_record_types", hidden=True), key=by_manual_sort)
     }
     
     for domain, domain_rec in lex_domains.items():
@@ -22,7 +22,9 @@ def main(url: str | None, name: str | None = None, desc: str | None = None, repo
     author = author and c.g.resolve_author(author)
     submissions = 0
     if url:
-        if not c.sites.get(url):
+        # the collector only loads a few columns for each site, so fetch the whole row here
+        old_record = next(iter(c.g.list_records(t.SITES, filter={kf.NORMAL_URL: [url]})[1]), None)
+        if not old_record:
             new_record = dict_filter_falsy({
                 ef.URL: url,
                 submissions_field: 1,
@@ -33,7 +35,6 @@ def main(url: str | None, name: str | None = None, desc: str | None = None, repo
                 ef.LEXICON: lexicon and int(lexicon),
             })
         else:
-            old_record: dict = c.sites[url]
             submissions = (old_s := old_record.get(c._prefix + submissions_field)) and old_s + 1 or 1
             new_record = {
                 ef.URL: url,
@@ -1,20 +1,31 @@
+import asyncio
 from collections import defaultdict
+from copy import deepcopy
 from enum import StrEnum
 from pprint import pp
-from typing import Any, Iterable, cast
-from atproto import IdResolver
-from pygrister.api import GristApi
+from typing import Any, Iterable, Iterator, cast
+from atproto import AsyncIdResolver, IdResolver
+from pygrister.api import GristApi, check_safemode
 from wmill import get_variable as wmill_var
 import json
+import os
 import re
+import time
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from f.main.boilerplate import add_missing, get_timed_logger
+from f.main.boilerplate import add_missing, batched, error_with_type, get_timed_logger, run_sync
+from f.main.identity_cache import IdentityCache
 utc = ZoneInfo("UTC")
 resolver = IdResolver()
+id_cache = IdentityCache()
 log = get_timed_logger(__name__)
 
+IDENTITY_RESOLVE_CONCURRENCY = int(os.environ.get("IDENTITY_RESOLVE_CONCURRENCY", 16))
+UPSERT_MAX_ROWS = int(os.environ.get("GRIST_UPSERT_MAX_ROWS", 500))
+UPSERT_MAX_BYTES = int(os.environ.get("GRIST_UPSERT_MAX_BYTES", 500_000))
+UPSERT_RETRIES = int(os.environ.get("GRIST_UPSERT_RETRIES", 2))
+
 class t(StrEnum):
     """atproto-tools table names"""
     SOURCES = "Data_Sources"
@@ -92,17 +103,35 @@ def match_handle(author) -> kf | None:
         if author_match := re.search(pattern, author):
             return author_match[1] #type: ignore    
 
+def is_hidden_col(col_id: str) -> bool:
+    """grist's own bookkeeping columns, which list_records leaves out by default"""
+    return col_id == "manualSort" or col_id.startswith("gristHelper_")
+
 class CustomGrister(GristApi):
     def __init__(self, config: dict[str, str] | None = None, in_converter: dict | None = None, out_converter: dict | None = None, request_options: dict | None = None, fetch_authors = False):
         super().__init__(config, in_converter, out_converter, request_options)
         self.authors_lookup: dict[kf, dict[str, Any]] = {}
         self._new_authors_records: dict[kf, dict[str, Any]] = {}
-        if not fetch_authors:
-            return
+        self.mirror = None
+        """local GristMirror that read_table goes through, if set"""
+        self._tables_cache: list[dict] | None = None
+        self._cols_cache: dict[str, list[dict]] = {}
+        """list_cols results by table id, hidden columns included"""
+        if fetch_authors:
+            self.load_authors()
+
+    def load_authors(self):
+        """fills authors_lookup from the Authors table, filling in missing handles/dids and merging duplicate rows"""
         authors_by_did: dict[kf, dict[str, dict[str, Any]]] = defaultdict(dict)
         invalid_dids: dict[kf, dict[str, Any]] = {}
-        old_records: list[dict[str, Any]] = self.list_records(t.AUTHORS)[1]
-        for row in old_records:
+        rows = list(self.read_table(t.AUTHORS))
+        # resolve every row that's missing a handle or a did in one concurrent pass, the lookups below then come from the cache
+        run_sync(self.resolve_identities(
+            row.get(kf.DID) or row[kf.HANDLE]
+            for row in rows
+            if bool(row.get(kf.DID)) != bool(row.get(kf.HANDLE))
+        ))
+        for row in rows:
             handle: kf | None = row.get(kf.HANDLE)
             did: kf | None = row.get(kf.DID)
             if did and not handle:
@@ -179,6 +208,54 @@ class CustomGrister(GristApi):
             #     self.add_update_records(t.AUTHORS, [i])
             self.add_update_records(t.AUTHORS, merged_authors)
 
+    @check_safemode
+    def add_update_records(self, table_id: str, records: list[dict], noparse: bool = False, onmany: str = 'first', noadd: bool = False, noupdate: bool = False, allow_empty_require: bool = False, doc_id: str = '', team_id: str = '') -> tuple[int, None]:
+        """
+        same as GristApi.add_update_records, except the payload is split into chunks of at most UPSERT_MAX_ROWS rows and UPSERT_MAX_BYTES bytes of json.
+        chunks are sent one after another (grist applies a doc's actions one at a time anyway), and a chunk that fails with a connection error, 429 or 5xx is retried.
+        grist commits each chunk on its own, so if one still fails, the IOError says how many of the chunks before it were already applied.
+        unlike the base method, the passed records aren't modified by the in_converter. blocks, so call it through asyncio.to_thread from async code
+        """
+        records = deepcopy(records)
+        if converter := self.in_converter.get(table_id):
+            for rec in records:
+                fields = rec.get(gf.FIELDS, {})
+                for col_id, convert in converter.items():
+                    if col_id in fields:
+                        fields[col_id] = convert(fields[col_id])
+
+        chunks: list[list[dict]] = []
+        chunk_size = 0
+        for rec in records:
+            rec_size = len(json.dumps(rec))
+            if not chunks or len(chunks[-1]) >= UPSERT_MAX_ROWS or chunk_size + rec_size > UPSERT_MAX_BYTES:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].append(rec)
+            chunk_size += rec_size
+
+        doc_id, server = self._select_params(doc_id, team_id)
+        url = f'{server}/docs/{doc_id}/tables/{table_id}/records'
+        params = {'noparse': noparse, 'onmany': onmany, 'noadd': noadd, 'noupdate': noupdate, 'allow_empty_require': allow_empty_require}
+        applied_rows = 0
+        for i, chunk in enumerate(chunks):
+            for attempt in range(UPSERT_RETRIES + 1):
+                try:
+                    self.apicall(url, 'PUT', params=params, json={'records': chunk})
+                    break
+                except IOError as e: # requests' exceptions are IOErrors too
+                    status = e.args[0] if e.args else None
+                    retryable = not isinstance(status, int) or status >= 500 or status == 429
+                    if not retryable or attempt == UPSERT_RETRIES:
+                        msg = f"{table_id} upsert failed at chunk {i + 1}/{len(chunks)}, after {i} chunks ({applied_rows}/{len(records)} rows) were applied: {e}"
+                        log.error(msg)
+                        raise IOError(status, msg) from e
+                    log.warning(f"retrying chunk {i + 1}/{len(chunks)} of {table_id} upsert after error: {e}")
+                    time.sleep(2 ** attempt)
+            applied_rows += len(chunk)
+        log.debug(f"upserted {len(records)} records into {table_id} in {len(chunks)} chunks")
+        return 200, None
+
     def format_records(self, entries: dict[kf, dict[str, Any]], rec_key: str):
         return [
             {
@@ -190,17 +267,69 @@ class CustomGrister(GristApi):
 
     """raises IOError with the request response on http error"""
     def apicall(self, url: str, method: str = 'GET', headers: dict | None = None, params: dict | None = None, json: dict | None = None, filename: str = '') -> tuple[int, Any]:
-        resp =  super().apicall(url, method, headers, params, json, filename)
-        if self.resp_code != 200:
-            raise IOError(
-                self.resp_code, f"{self.resp_reason}: {self.resp_content}"
-            )
-        return resp
+        status, content = super().apicall(url, method, headers, params, json, filename)
+        # report what this call returned rather than self.resp_*, which may already belong to another thread's call
+        if status != 200:
+            raise IOError(status, f"{url}: {content}")
+        if self.mirror and method != 'GET' and (m := re.search(r"/tables/([^/]+)/records", url)):
+            self.mirror.expire(m[1])
+        return status, content
+
+    # schema reads for the configured doc are cached for the lifetime of the client, and dropped by any of the methods below that change the schema
+    def list_tables(self, doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        if doc_id or team_id:
+            return super().list_tables(doc_id, team_id)
+        if self._tables_cache is None:
+            self._tables_cache = super().list_tables()[1]
+        return 200, self._tables_cache
+
+    def list_cols(self, table_id: str, hidden: bool = False, doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        if doc_id or team_id:
+            return super().list_cols(table_id, hidden, doc_id, team_id)
+        if table_id not in self._cols_cache:
+            self._cols_cache[table_id] = super().list_cols(table_id, hidden=True)[1]
+        cols = self._cols_cache[table_id]
+        return 200, cols if hidden else [col for col in cols if not is_hidden_col(col["id"])]
+
+    def add_tables(self, tables: list[dict], doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        try:
+            return super().add_tables(tables, doc_id, team_id)
+        finally:
+            self._tables_cache = None
+            for table in tables:
+                self._cols_cache.pop(table["id"], None)
+
+    def update_tables(self, tables: list[dict], doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        try:
+            return super().update_tables(tables, doc_id, team_id)
+        finally:
+            # a table's metadata can rename it, so nothing cached by table id is safe to keep
+            self._tables_cache = None
+            self._cols_cache.clear()
+
+    def add_cols(self, table_id: str, cols: list[dict], doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        try:
+            return super().add_cols(table_id, cols, doc_id, team_id)
+        finally:
+            self._cols_cache.pop(table_id, None)
+
+    def update_cols(self, table_id: str, cols: list[dict], doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        try:
+            return super().update_cols(table_id, cols, doc_id, team_id)
+        finally:
+            self._cols_cache.pop(table_id, None)
+
+    def delete_column(self, table_id: str, col_id: str, doc_id: str = '', team_id: str = '') -> tuple[int, Any]:
+        try:
+            return super().delete_column(table_id, col_id, doc_id, team_id)
+        finally:
+            self._cols_cache.pop(table_id, None)
 
     # don't like doing this but the put columns enpdoint has really weird behaviour, sometimes it invents a new id for you and makes a new column with it
     # also changed the noadd and noupdate default params, kinda weird to have both of those true by default.
     def add_update_cols(self, table_id: str, cols: list[dict], noadd: bool = False, noupdate: bool = False, replaceall: bool = False, doc_id: str = '', team_id: str = ''):
         if replaceall:
+            self._cols_cache.pop(table_id, None)
             return super().add_update_cols(
                 table_id, cols, noadd, noupdate, replaceall, doc_id, team_id
             )
@@ -211,8 +340,92 @@ class CustomGrister(GristApi):
             col_ids |= set(self.add_cols(table_id, [col for col in cols if col["id"] in new_col_ids])[1])
         elif (update_col_ids := col_ids & target_col_ids) and not noupdate:
             super().add_update_cols(table_id, [col for col in cols if col["id"] in update_col_ids], noadd=True)
+            self._cols_cache.pop(table_id, None)
         return int(self.resp_code), col_ids
 
+    def _col_types(self, table_id: str) -> dict[str, str]:
+        """{col_id: type} for all of a table's columns, hidden ones included"""
+        return {col["id"]: col["fields"]["type"] for col in self.list_cols(table_id, hidden=True)[1]}
+
+    def _select(self, table_id: str, col_types: dict[str, str], col_ids: Iterable[str], where: str = "", args: list | None = None, limit: int = 0, convert: bool = True) -> tuple[int, list[dict[str, Any]]]:
+        selected = [kf.ID, *(i for i in dict.fromkeys(col_ids) if i in col_types)]
+        cols_sql = ", ".join(f'"{i}"' for i in selected)
+        query = f'SELECT {cols_sql} FROM "{table_id}"'
+        if where:
+            query += f" WHERE {where}"
+        if limit:
+            query += f" ORDER BY id LIMIT {int(limit)}"
+        status, records = self.run_sql_with_args(query, args or [])
+        # the sql endpoint gives back the raw cells, where list columns are json strings and bools are 0/1
+        list_cols = [i for i in selected if col_types.get(i, "").startswith("RefList:") or col_types.get(i) in ("ChoiceList", "Attachments")]
+        bool_cols = [i for i in selected if col_types.get(i) == "Bool"]
+        converter = self.out_converter.get(table_id, {}) if convert else {}
+        for rec in records:
+            for col_id in list_cols:
+                rec[col_id] = ["L", *json.loads(val)] if (val := rec.get(col_id)) else None
+            for col_id in bool_cols:
+                if rec.get(col_id) is not None:
+                    rec[col_id] = bool(rec[col_id])
+            for col_id, convert in converter.items():
+                if col_id in rec:
+                    rec[col_id] = convert(rec[col_id])
+        return status, records
+
+    def select_records(self, table_id: str, col_ids: Iterable[str], where: str = "", args: list | None = None) -> tuple[int, list[dict[str, Any]]]:
+        """
+        column-projected alternative to list_records that goes through the sql endpoint. columns missing from the table are skipped
+
+        Args:
+            table_id (str): the grist table id
+            col_ids (Iterable[str]): columns to fetch. id is always included
+            where (str, optional): sql WHERE clause (without the keyword), with ? placeholders for args. Defaults to all rows.
+            args (list | None, optional): values for the placeholders in where
+
+        Returns:
+            tuple[int, list[dict[str, Any]]]: status code and records shaped like list_records output (reflists as ["L", ...], out_converters applied)
+        """
+        return self._select(table_id, self._col_types(table_id), col_ids, where, args)
+
+    def iter_records(self, table_id: str, col_ids: Iterable[str] | None = None, where: str = "", args: list | None = None, page_size: int = 500, hidden: bool = False, convert: bool = True) -> Iterator[dict[str, Any]]:
+        """
+        pages through a table in row id order, yielding records shaped like list_records output.
+        unlike list_records, the table size isn't capped by grist's max response size, and only one page is held in memory at a time
+
+        Args:
+            table_id (str): the grist table id
+            col_ids (Iterable[str] | None, optional): columns to fetch. Defaults to all columns, without the hidden ones unless `hidden` is set.
+            where (str, optional): sql filter, same as in select_records
+            args (list | None, optional): values for the placeholders in where
+            page_size (int, optional): rows per request. Defaults to 500.
+            convert (bool, optional): whether to apply out_converters. Defaults to True.
+        """
+        col_types = self._col_types(table_id)
+        if col_ids is None:
+            col_ids = [i for i in col_types if hidden or not is_hidden_col(i)]
+        col_ids = list(col_ids)
+        page_where = f"({where}) AND id > ?" if where else "id > ?"
+        last_id = 0
+        while True:
+            page = self._select(table_id, col_types, col_ids, page_where, [*(args or []), last_id], page_size, convert)[1]
+            yield from page
+            if len(page) < page_size:
+                return
+            last_id = page[-1][kf.ID]
+
+    def read_table(self, table_id: str, col_ids: Iterable[str] | None = None, hidden: bool = False) -> Iterator[dict[str, Any]]:
+        """reads a whole table, from the local mirror if one is set up (see f.main.grist_mirror), otherwise with iter_records"""
+        if self.mirror:
+            return self.mirror.iter_records(table_id, col_ids, hidden)
+        return self.iter_records(table_id, col_ids, hidden=hidden)
+
+    def select_records_in(self, table_id: str, col_ids: Iterable[str], values: Iterable, match_col: str = kf.ID, batch_size: int = 500) -> list[dict[str, Any]]:
+        """select_records for the rows whose match_col (row id by default) is one of values. batched to stay under sqlite's limit on query parameters"""
+        out = []
+        for batch in batched(list(dict.fromkeys(values)), batch_size):
+            placeholders = ", ".join("?" * len(batch))
+            out += self.select_records(table_id, col_ids, f'"{match_col}" IN ({placeholders})', batch)[1]
+        return out
+
     def get_colRef(self, table_id: str, col_id: str) -> int | None:
         return next((col["fields"]["colRef"] for col in self.list_cols(table_id)[1] if col["id"] == col_id), None)
 
@@ -237,14 +450,62 @@ class CustomGrister(GristApi):
         if handle := self.authors_lookup.get(cast(kf, did), {}).get(kf.HANDLE):
             log.debug(f'cache hit for {handle} handle lookup')
             return handle
-        if (resp := resolver.did.resolve(did)) and (handle := resp.get_handle()):
+        hit, handle = id_cache.get(did)
+        if not hit:
+            handle = (resp := resolver.did.resolve(did)) and resp.get_handle()
+            id_cache.set(did, handle or None)
+        if handle:
             return cast(kf, handle)
 
     def _fetch_did(self, handle: str) -> kf | None:
         """usually better to use self.resolve_author since it has a cache"""
-        if out := resolver.handle.resolve(handle):
+        hit, out = id_cache.get(handle)
+        if not hit:
+            out = resolver.handle.resolve(handle)
+            id_cache.set(handle, out or None)
+        if out:
             return cast(kf, out)
 
+    async def resolve_identities(self, identities: Iterable[str]) -> dict[str, kf | None]:
+        """
+        resolves many identities at once: dids to handles, and handles or bsky.app profile links to dids.
+        inputs are deduped, checked against authors_lookup and the identity cache, and the rest are resolved concurrently.
+        the results land in the identity cache, so later resolve_author/get_handle calls for them don't touch the network
+
+        Returns:
+            dict[str, kf | None]: {input: resolved handle or did}. inputs that aren't valid identities are left out
+        """
+        keys: dict[str, str] = {}
+        for identity in identities:
+            if did_match := re.search(did_regex, identity):
+                keys[identity] = did_match["did"]
+            elif handle := match_handle(identity):
+                keys[identity] = handle
+        async_resolver = AsyncIdResolver()
+        sem = asyncio.Semaphore(IDENTITY_RESOLVE_CONCURRENCY)
+
+        async def resolve(key: str) -> kf | None:
+            is_did = key.startswith("did:")
+            if known := self.authors_lookup.get(cast(kf, key), {}).get(kf.HANDLE if is_did else kf.DID):
+                return known
+            hit, value = id_cache.get(key)
+            if not hit:
+                async with sem:
+                    try:
+                        if is_did:
+                            value = (doc := await async_resolver.did.resolve(key)) and doc.get_handle()
+                        else:
+                            value = await async_resolver.handle.resolve(key)
+                    except Exception as e:
+                        log.error(f"could not resolve {key}: {error_with_type(e)}")
+                        return None
+                id_cache.set(key, value or None)
+            return cast(kf, value) if value else None
+
+        unique_keys = list(set(keys.values()))
+        results = dict(zip(unique_keys, await asyncio.gather(*(resolve(key) for key in unique_keys))))
+        return {identity: results[key] for identity, key in keys.items()}
+
     def resolve_author(self, author: str) -> None | kf:
         """converts handle or profile link to did. if not found, resolves it."""
         if did_match := re.search(did_regex, author):
@@ -274,7 +535,8 @@ class CustomGrister(GristApi):
         if not self._new_authors_records:
             return
         self.add_update_records(t.AUTHORS, list(self._new_authors_records.values()))
-        for entry in self.list_records(t.AUTHORS)[1]:
+        # the PUT endpoint doesn't return ids, so look up just the rows that were written
+        for entry in self.select_records_in(t.AUTHORS, [kf.DID, kf.HANDLE], self._new_authors_records.keys(), kf.DID):
             self.authors_lookup.setdefault(entry[kf.DID], {}).update(
                 id = entry["id"],
                 did = entry[kf.DID],
@@ -298,11 +560,20 @@ in_converters = {
     }
 }
 
+GRIST_MIRROR_PATH = os.environ.get("GRIST_MIRROR_PATH", "")
+"""path of the local sqlite mirror. the mirror is disabled if unset"""
+
 def ATPTGrister(fetch_authors = False) -> CustomGrister:
     """Get configured GristApi client"""
     grist_config = json.loads(wmill_var("f/main/grist_config"))
     grist_config["GRIST_API_KEY"] = wmill_var("u/autumn/GRIST_API_KEY")
-    return CustomGrister(grist_config, fetch_authors=fetch_authors, in_converter=in_converters, out_converter=out_converters)
+    g = CustomGrister(grist_config, in_converter=in_converters, out_converter=out_converters)
+    if GRIST_MIRROR_PATH:
+        from f.main.grist_mirror import GristMirror
+        g.mirror = GristMirror(g, GRIST_MIRROR_PATH)
+    if fetch_authors:
+        g.load_authors()
+    return g
 
 if __name__ == "__main__":
     g = ATPTGrister(True)
@@ -5,8 +5,9 @@ from typing import Iterable, Any, cast
 from pprint import pformat
 from f.main.ATPTGrister import ATPTGrister, check_stale, mf, t, gf, kf, make_timestamp, normalize_url
 import feedparser
-from f.main.boilerplate import add_missing, add_one_missing, get_timed_logger, recursive_defaultdict, dicts_diff
-from f.main.fetch_site_meta import check_and_fetch, names_col
+from f.main.boilerplate import add_missing, add_one_missing, get_timed_logger, recursive_defaultdict, dicts_diff, run_sync
+from f.main.fetch_site_meta import check_and_fetch, names_col, shutdown_parse_pool
+from f.main.canonical_urls import canonical_urls
 log = get_timed_logger(__name__) #TODO add more logging in collector.py
 
 class ef(StrEnum):
@@ -32,6 +33,11 @@ class tf(StrEnum):
     HOME = "homepageUrl"
     ALT_URLS = "alt_urls"
 
+site_key_cols = [kf.NORMAL_URL, tf.URL, tf.ALT_URLS, t.SOURCES, t.LEXICONS]
+"""Sites columns loaded for every row on startup. the heavier ones (names, source-specific columns) are only loaded for rows the run touches"""
+repo_key_cols = [kf.NORMAL_URL, tf.URL, tf.ALT_URLS, t.SOURCES, t.SITES, kf.NORMAL_HOME, tf.HOME, mf.POLLED]
+"""Repos columns read by the collector"""
+
 class cmk(StrEnum):
     source_name = "source_name"
     fields= "fields"
@@ -54,42 +60,30 @@ class Collector:
             add_repo (bool, optional): whether to check for repo link when adding entries. Defaults to False.
             authors (boo, optional): whether to prefetch authors. Defaults to False.
         """
-        self.g = ATPTGrister(fetch_authors)
+        self.g = ATPTGrister()
+        self.g.open_session() # one keep-alive connection pool for the concurrent startup reads and everything after
         self._source_name = source_name
         self._prefix = source_name + "_"
-        sources = self.g.list_records(t.SOURCES)[1]
-        source_record = next(i for i in sources if i["source_name"] == source_name)
+        # the feed is checked before anything else so a run with no updates stops before any big table is downloaded
+        source_record = self.g.list_records(t.SOURCES, {"source_name": [source_name]})[1][0]
+        self._source_id = source_record["id"]
+        self._source_label = source_record["label"]
         self.last_update_timestamp: int = source_record.get("last_update_timestamp") or 0
         self.current_update_timestamp: int = 0
         if source_feed := source_record.get("feed"):
             #TODO fix type annotations in feedparser upstream
             self.check_update_timestamp(feedparser.parse(source_feed).feed.updated) #type: ignore
-        self._source_id = source_record["id"]
-        self._source_label = source_record["label"]
         self._fields: list[str] = [self._prefix + i for i in fields]
         self._df = {i: self._prefix + i for i in set(fields) - {ef.NAME, ef.DESC}}
 
         self.new_sites: dict[kf, dict[str, Any]] = {}
         self.new_authors: dict[kf, dict[str, Any]] = {}
         self.new_repos: dict[kf, dict[str, Any]] = {}
-        #TODO rewrite these to narrower sql queries to only get existing entries from our source and only grab relevant fields. would also need to move this code to after processing all the urls to the source
-        #TODO maybe also make the initial fetches concurrent with async
         self.sites = {}
-        self._alt_urls: dict[kf, kf] = {}
-        for rec in self.g.list_records(t.SITES)[1]:
-            normal_url = rec[kf.NORMAL_URL]
-            self.sites[normal_url] = rec
-            if rec_alt_urls := rec.get(tf.ALT_URLS):
-                self._alt_urls |= {alt: normal_url for alt in rec_alt_urls.splitlines()}
-        # max allowed size is 1mb. truncated by default, change MAXSAVEDRESP to MAXSAVEDRESP = 1000000 in grister's api.py
-        log.info(f"Sites is {len(self.g.resp_content) / 1000000 } of max request size")
         self.repos = {}
+        self._alt_urls: dict[kf, kf] = {}
         self._add_repos_opt = add_repos
-        for rec in self.g.list_records(t.REPOS)[1]:
-            normal_url = rec[kf.NORMAL_URL]
-            self.repos[normal_url] = rec
-            if rec_alt_urls := rec.get(tf.ALT_URLS):
-                self._alt_urls |= {alt: normal_url for alt in rec_alt_urls.splitlines()}
+        run_sync(self._load_tables(fetch_authors))
         self.authors = self.g.authors_lookup
 
         self._tags_set: set[str] = set()
@@ -115,6 +109,41 @@ class Collector:
         self.write_meta = write_meta
         log.info(f"finished collector setup for {self._source_label}")
 
+    async def _load_tables(self, fetch_authors: bool):
+        """fetches Sites, Repos and (optionally) Authors concurrently"""
+        sites, repos, _ = await asyncio.gather(
+            asyncio.to_thread(list, self.g.read_table(t.SITES, site_key_cols)),
+            asyncio.to_thread(list, self.g.read_table(t.REPOS, repo_key_cols)),
+            asyncio.to_thread(self.g.load_authors) if fetch_authors else asyncio.sleep(0),
+        )
+        for rec in sites:
+            normal_url = rec[kf.NORMAL_URL]
+            self.sites[normal_url] = rec
+            if rec_alt_urls := rec.get(tf.ALT_URLS):
+                self._alt_urls |= {alt: normal_url for alt in rec_alt_urls.splitlines()}
+        for rec in repos:
+            normal_url = rec[kf.NORMAL_URL]
+            self.repos[normal_url] = rec
+            if rec_alt_urls := rec.get(tf.ALT_URLS):
+                self._alt_urls |= {alt: normal_url for alt in rec_alt_urls.splitlines()}
+        self._alt_urls = self._redirect_alt_urls() | self._alt_urls # listed alt_urls take precedence
+        log.info(f"loaded {len(self.sites)} sites and {len(self.repos)} repos")
+
+    def _redirect_alt_urls(self) -> dict[kf, kf]:
+        """
+        alt urls from the redirects seen while fetching sites and repos: an address that redirects to a known site or repo, or that a known one redirects from, maps to its row.
+        redirects between two addresses that are both unknown (or both already rows) are left alone, a shared login page shouldn't merge unrelated sites
+        """
+        out: dict[kf, kf] = {}
+        for url, canonical in canonical_urls.redirects().items():
+            url, canonical = cast(kf, url), cast(kf, canonical)
+            for rows in (self.sites, self.repos):
+                if canonical in rows and url not in rows:
+                    out[url] = canonical
+                elif url in rows and canonical not in rows:
+                    out[canonical] = url
+        return out
+
     def check_update_timestamp(self, timestamp: str | int | float):
         self.current_update_timestamp = make_timestamp(timestamp)
         if self.last_update_timestamp == self.current_update_timestamp:
@@ -166,6 +195,31 @@ class Collector:
         self._tags_applied = True
         return og_tags
 
+    def _load_site_fields(self):
+        """fills in the rest of the columns for existing sites that are either in this source or seen in this run"""
+        row_ids = [
+            rec[kf.ID] for url, rec in self.sites.items()
+            if url in self.new_sites or self._source_id in (rec.get(t.SOURCES) or [])
+        ]
+        for rec in self.g.select_records_in(t.SITES, [kf.NORMAL_URL, names_col, *self._fields], row_ids):
+            self.sites[rec[kf.NORMAL_URL]] |= rec
+
+    async def _fetch_sites_meta(self, stale_threshold: float):
+        """fetches metadata for all the stale new sites at once (concurrency is bounded by fetch_site_meta.scheduler) and merges it into their names"""
+        urls = list(self.new_sites)
+        try:
+            metas = await asyncio.gather(*(
+                check_and_fetch(self.sites.get(url) or self.new_sites[url], stale_threshold)
+                for url in urls
+            ))
+        finally:
+            await asyncio.to_thread(shutdown_parse_pool)
+        for url, new_meta in zip(urls, metas):
+            if new_meta:
+                entry = self.new_sites[url]
+                # new_meta is based on the stored names, so put this source's names back on top
+                entry[names_col] = new_meta | (entry.get(names_col) or {})
+
     def _p(self, key: str, new: Any = None, old: Any = None) -> None:
         if old and new:
             log.info(f"\nDuplicate for {key}:\n{pformat(old)}\n->\n{pformat(new)}")
@@ -311,6 +365,9 @@ class Collector:
         for key, entry in new_entries.items():
             if old_entry := old_entries.get(key):
                 entry = dicts_diff(old_entry, entry)
+                if names_col in entry:
+                    # names is a single json cell, so it has to be written whole rather than as a diff
+                    entry[names_col] = (old_entry.get(names_col) or {}) | new_entries[key][names_col]
             if entry:
                 out.append({gf.KEY: {keyfield: key}, gf.FIELDS: entry})
 
@@ -383,13 +440,14 @@ class Collector:
             log.debug(f"wrote cols {[col['id'] for col in cols_tables]}")
 
 
-        for url, entry in self.new_sites.items():
-            if new_meta := check_and_fetch(self.sites.get(url) or entry, 14):
-                entry[names_col] = new_meta
-            
-        self._write_record_table(t.SITES)
-        #TODO SQL filters here too
-        self.sites = {i[kf.NORMAL_URL]: i for i in self.g.list_records(t.SITES)[1]}
+        self._load_site_fields()
+        await self._fetch_sites_meta(14)
+        # grist writes block, so they go to a worker thread to keep the event loop free
+        await asyncio.to_thread(self._write_record_table, t.SITES)
+        # the repo and author references need the ids of the sites that were just added
+        added_urls = [url for url in self.new_sites if url not in self.sites]
+        for rec in await asyncio.to_thread(self.g.select_records_in, t.SITES, site_key_cols, added_urls, kf.NORMAL_URL):
+            self.sites[rec[kf.NORMAL_URL]] = rec
 
         if self.write_meta:
             #TODO these can run in parallel
@@ -423,10 +481,11 @@ class Collector:
             for did, fields in authors_metadata.items():
                 self.new_authors[did] |= fields
 
-        repos = self._write_record_table(t.REPOS)
-        authors = self._write_record_table(t.AUTHORS)
+        repos = await asyncio.to_thread(self._write_record_table, t.REPOS)
+        authors = await asyncio.to_thread(self._write_record_table, t.AUTHORS)
         if self.current_update_timestamp:
-            self.g.add_update_records(
+            await asyncio.to_thread(
+                self.g.add_update_records,
                 t.SOURCES,
                 [
                     {
@@ -452,7 +511,7 @@ class Collector:
         ]}
 
     def output(self, display_fields: list[str] = [], dry_run: bool = False) -> dict[str, list[Any]]:
-        return asyncio.run(self._output(display_fields, dry_run))
+        return run_sync(self._output(display_fields, dry_run))
 
 if __name__ == "__main__":
     c = Collector("Official_showcase")
@@ -1,11 +1,14 @@
 # py: >=3.12
 # boilerplate for basic functinality? in MY python??
+import asyncio
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import random
 import time
 import os
-from typing import Any, Container, Iterable, Mapping
+import weakref
+from typing import Any, Callable, Container, Coroutine, Iterable, Mapping
 # TODO consider switching to a different parsing lib https://sethmlarson.dev/why-urls-are-hard-path-params-urlparse
 from urllib.parse import urlparse, parse_qsl, unquote, urlunparse
 
@@ -76,6 +79,30 @@ def get_timed_logger(name: str = "", level: str | int | None = None) -> TimedLog
 
 log = get_timed_logger(__name__)
 
+def run_sync[T](coro: Coroutine[Any, Any, T]) -> T:
+    """asyncio.run, but also usable from sync code that is itself called inside a running event loop (runs the coroutine in a worker thread then)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+class LoopLocal[T]:
+    """
+    one T per running event loop, made on first use. for module level asyncio objects (async clients, semaphores), which get tied to the first loop that uses them,
+    while run_sync starts a new loop on every call
+    """
+    def __init__(self, factory: Callable[[], T]):
+        self.factory = factory
+        self._by_loop: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, T] = weakref.WeakKeyDictionary()
+
+    def get(self) -> T:
+        loop = asyncio.get_running_loop()
+        if loop not in self._by_loop:
+            self._by_loop[loop] = self.factory()
+        return self._by_loop[loop]
+
 def error_with_type(e: BaseException):
     return ": ".join((e.__class__.__name__, str(e)))
 
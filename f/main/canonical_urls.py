@@ -0,0 +1,28 @@
+import os
+from f.main.boilerplate import get_timed_logger
+from f.main.sqlite_cache import SqliteCache, cache_path
+log = get_timed_logger(__name__)
+
+CANONICAL_URL_CACHE_PATH = os.environ.get("CANONICAL_URL_CACHE_PATH", cache_path("canonical_urls"))
+CANONICAL_URL_CACHE_TTL = float(os.environ.get("CANONICAL_URL_CACHE_TTL", 30 * 24 * 60 * 60))
+"""seconds a seen redirect is trusted for"""
+
+class CanonicalUrlCache(SqliteCache):
+    """
+    on-disk record of the redirects seen for sites and repos, as normalized url -> normalized final url (e.g. a renamed github repo's new address).
+    lets the collector fold a site or repo listed under an old or alternate address into the row for where it actually lives
+    """
+    def __init__(self, path: str = CANONICAL_URL_CACHE_PATH, ttl: float = CANONICAL_URL_CACHE_TTL):
+        super().__init__(path, ttl)
+
+    def set(self, url: str, canonical: str):
+        if url == canonical:
+            self.delete(url) # doesn't redirect (anymore)
+        else:
+            log.debug(f"{url} redirects to {canonical}")
+            super().set(url, canonical)
+
+    def redirects(self) -> dict[str, str]:
+        return self.items()
+
+canonical_urls = CanonicalUrlCache()
@@ -1,13 +1,14 @@
 import os
 from typing import Annotated, AsyncIterable, TypedDict
 from pydantic import BaseModel, Field, BeforeValidator
-from httpx import Client, Request
+from httpx import Request
+from f.main.http_clients import client
 from at_url_converter import at_url
 from atproto_core.nsid import validate_nsid as _validate_nsid
 from atproto_client.models.string_formats import Did, Nsid, RecordKey
 
 CONSTELLATION_URL = os.environ.get("CONSTELLATION_URL", "https://constellation.microcosm.blue")
-c = Client(headers={"Accept": "application/json"}, base_url=CONSTELLATION_URL, timeout=30, follow_redirects=True)
+c = client(headers={"Accept": "application/json"}, base_url=CONSTELLATION_URL, timeout=30, follow_redirects=True)
 
 def validate_nsid(value: str):
     _validate_nsid(value)
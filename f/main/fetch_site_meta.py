@@ -1,102 +1,235 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from copy import deepcopy
 from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+import fcntl
+import itertools
+import json
+import multiprocessing
 import os
-from typing import Any, Literal, TypedDict, cast
+import tempfile
+import time
+from typing import Any, Literal, cast
 import httpx
-from bs4 import BeautifulSoup, Tag, NavigableString
 import re
-from f.main.boilerplate import batched, dicts_diff, dict_filter_falsy, truthy_only_dict
-from f.main.ATPTGrister import ATPTGrister, check_stale, gf, kf, names_col, site_source_name
+from f.main.boilerplate import LoopLocal, dicts_diff
+from f.main.ATPTGrister import ATPTGrister, CustomGrister, check_stale, gf, kf, names_col, normalize_url, site_source_name
+from f.main.canonical_urls import canonical_urls
+from f.main.html_meta import parse_head, site_info
 from f.main.boilerplate import get_timed_logger
+from f.main.http_clients import async_client
 log = get_timed_logger(__name__)
 
 
 FETCH_SITE_TIMEOUT = int(os.environ.get("FETCH_SITE_TIMEOUT", 20))
-CONCURRENT_FETCH_SITE_LIMIT = int(os.environ.get("CONCURRENT_CONNECTION_LIMIT", 8))
-c = httpx.AsyncClient(follow_redirects=True, timeout=FETCH_SITE_TIMEOUT, trust_env=True)
-
-def clean_title(title: str | None, url: str):
-    if not title:
-        return ""
-    if url.startswith("https://github.com"):
-        title = re.sub(r"GitHub - [^/]+/[^:]+: ", "", title)
-    return title
-
-def clean_description(desc: str | None, url: str):
-    if not desc:
-        return ""
-    if re.search(r"development by creating an account on GitHub\.$", desc):
-        return ""
-    return desc
-
-class site_info(TypedDict, total=False):
-    title: str
-    desc: str
-    error: str
-    last_polled: str
-    normalized_url: str
-
-
-sem = asyncio.Semaphore(CONCURRENT_FETCH_SITE_LIMIT)
+CONCURRENT_FETCH_SITE_LIMIT = int(os.environ.get("CONCURRENT_CONNECTION_LIMIT", 32))
+CONCURRENT_FETCH_PER_HOST_LIMIT = int(os.environ.get("CONCURRENT_FETCH_PER_HOST_LIMIT", 2))
+FETCH_SITE_RETRIES = int(os.environ.get("FETCH_SITE_RETRIES", 2))
+"""times a fetch is retried after a 429/503"""
+FETCH_SITE_MAX_BACKOFF = float(os.environ.get("FETCH_SITE_MAX_BACKOFF", 60))
+FETCH_SITE_MAX_HEAD_BYTES = int(os.environ.get("FETCH_SITE_MAX_HEAD_BYTES", 512 * 1024))
+FETCH_SITE_MAX_CONTENT_LENGTH = int(os.environ.get("FETCH_SITE_MAX_CONTENT_LENGTH", 10 * 1024 * 1024))
+"""responses that declare a bigger body are dropped without reading any of it"""
+FETCH_SITE_PARSE_WORKERS = int(os.environ.get("FETCH_SITE_PARSE_WORKERS", 0))
+"""
+processes that parse fetched pages, so big crawls parse on every core instead of the event loop. 0 (the default) parses on the event loop.
+opt-in because multiprocessing re-imports the entry script in each worker: only set it for scripts whose module level code is behind an `if __name__ == "__main__"` guard
+"""
+FETCH_SITE_FLUSH_ROWS = int(os.environ.get("FETCH_SITE_FLUSH_ROWS", 100))
+FETCH_SITE_FLUSH_SECONDS = float(os.environ.get("FETCH_SITE_FLUSH_SECONDS", 30))
+"""_main writes its results to grist every FETCH_SITE_FLUSH_ROWS sites or FETCH_SITE_FLUSH_SECONDS, whichever comes first"""
+FETCH_SITE_JOURNAL_DIR = os.environ.get("FETCH_SITE_JOURNAL_DIR", tempfile.gettempdir())
+FETCH_SITE_JOURNAL_MAX_AGE = float(os.environ.get("FETCH_SITE_JOURNAL_MAX_AGE", 24 * 60 * 60))
+"""seconds since its last entry after which an unfinished run's journal is ignored instead of resumed"""
+SITE_POLL_MIN_DAYS = float(os.environ.get("SITE_POLL_MIN_DAYS", 1))
+SITE_POLL_MAX_DAYS = float(os.environ.get("SITE_POLL_MAX_DAYS", 60))
+SITE_POLL_ERROR_MAX_DAYS = float(os.environ.get("SITE_POLL_ERROR_MAX_DAYS", 14))
+"""longest a site that keeps erroring waits between polls"""
+c = LoopLocal(lambda: async_client(CONCURRENT_FETCH_SITE_LIMIT, follow_redirects=True, timeout=FETCH_SITE_TIMEOUT, trust_env=True))
+
+validator_headers = {"etag": "If-None-Match", "last_modified": "If-Modified-Since"}
+"""site_info validator keys, and the conditional request header each one is sent back as"""
+poll_bookkeeping_keys = ("last_polled", "poll_interval", "error_streak", *validator_headers)
+"""site_info keys that change from poll to poll without the site's metadata changing"""
+
+
+html_content_types = {"text/html", "application/xhtml+xml"}
+
+class UnsupportedContentType(httpx.HTTPError):
+    pass
+
+class ResponseTooLarge(httpx.HTTPError):
+    pass
+
+def check_response(response: httpx.Response):
+    """raises before the body is read if the headers say it isn't an html page, or is too big to be worth downloading"""
+    content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type and content_type not in html_content_types:
+        raise UnsupportedContentType(content_type)
+    if (length := response.headers.get("content-length", "")).isdigit() and int(length) > FETCH_SITE_MAX_CONTENT_LENGTH:
+        raise ResponseTooLarge(f"{length} bytes")
+
+head_end_regex = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+
+async def read_head(response: httpx.Response) -> bytes:
+    """reads a streamed response only up to the end of <head> (or FETCH_SITE_MAX_HEAD_BYTES), the rest of the body is never downloaded"""
+    head = bytearray()
+    async for chunk in response.aiter_bytes():
+        search_start = max(0, len(head) - 8) # the closing tag may be split across chunks
+        head += chunk
+        if head_end := head_end_regex.search(head, search_start):
+            return bytes(head[:head_end.start()])
+        if len(head) >= FETCH_SITE_MAX_HEAD_BYTES:
+            log.debug(f"no end of <head> in the first {FETCH_SITE_MAX_HEAD_BYTES} bytes of {response.url}")
+            return bytes(head[:FETCH_SITE_MAX_HEAD_BYTES])
+    return bytes(head)
+
+class HostScheduler:
+    """
+    global limit on concurrent fetches, plus a per-host one so a burst of urls on one host can't get us throttled by it.
+    a host that answers 429/503 is paused (for its Retry-After, or an exponential backoff) while fetches to other hosts carry on
+    """
+    def __init__(self, limit: int, per_host_limit: int):
+        self.sem = asyncio.Semaphore(limit)
+        self.per_host_limit = per_host_limit
+        self.host_sems: dict[str, asyncio.Semaphore] = {}
+        self.paused_until: dict[str, float] = {}
+
+    @asynccontextmanager
+    async def slot(self, host: str):
+        # take the host slot first, so requests queued behind a busy or paused host don't hold global slots
+        async with self.host_sems.setdefault(host, asyncio.Semaphore(self.per_host_limit)):
+            while (wait := self.paused_until.get(host, 0) - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+            async with self.sem:
+                yield
+
+    def back_off(self, host: str, response: httpx.Response, attempt: int):
+        if (delay := parse_retry_after(response.headers.get("retry-after"))) is None: # 0 is a valid "retry right away"
+            delay = 2 ** attempt
+        delay = min(delay, FETCH_SITE_MAX_BACKOFF)
+        log.warning(f"{response.status_code} from {host}, pausing it for {delay:.0f}s")
+        self.paused_until[host] = max(self.paused_until.get(host, 0), time.monotonic() + delay)
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After is either a number of seconds or an http date. a date that has already passed means no wait"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+backoff_statuses = {httpx.codes.TOO_MANY_REQUESTS, httpx.codes.SERVICE_UNAVAILABLE}
+scheduler = LoopLocal(lambda: HostScheduler(CONCURRENT_FETCH_SITE_LIMIT, CONCURRENT_FETCH_PER_HOST_LIMIT))
+_parse_pool: ProcessPoolExecutor | None = None
+parse_sem = LoopLocal(lambda: asyncio.Semaphore(max(1, FETCH_SITE_PARSE_WORKERS) * 2))
+
+def parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        # forkserver, since forking a process that's running grister and sqlite threads isn't safe.
+        # the server imports the parser once, and each worker is forked from it already loaded
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["f.main.html_meta"])
+        _parse_pool = ProcessPoolExecutor(FETCH_SITE_PARSE_WORKERS, mp_context=ctx)
+    return _parse_pool
+
+def shutdown_parse_pool():
+    """stops the parse workers, if any were started. a later parse starts a new pool. blocks until they exit, so async code runs it in a thread"""
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
+
+async def parse_in_pool(head: bytes, url: str) -> site_info:
+    """
+    runs parse_head in the worker processes, so parsing overlaps with fetching instead of blocking the event loop.
+    the pool has its own limit (2 queued pages per worker) apart from the network one, and fetches wait for a free spot
+    """
+    if not FETCH_SITE_PARSE_WORKERS:
+        return parse_head(head, url)
+    async with parse_sem.get():
+        return await asyncio.get_running_loop().run_in_executor(parse_pool(), parse_head, head, url)
+
 #TODO add rel-alternate atproto links
-async def fetch_site_meta(url: str) -> site_info:
-    async with sem:
-        try:
-            out: site_info = {}
-            response = await c.get(url)
-            response.raise_for_status()
-            # some of the sites i tested returned improperly decoded chars by default, for example https://publer.com
-            # therefore, by executive fiat:
-            response.encoding = 'utf-8'
-            # response.encoding = response.apparent_encoding # https://stackoverflow.com/a/58578323/592606
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            og_title_tag = (
-                soup.find('meta', attrs={'property': 'og:title'}) or
-                soup.find('meta', attrs={'name': 'og:title'})
-            )
-
-            if og_title_tag:
-                assert not isinstance(og_title_tag, NavigableString)
-                out["title"] = clean_title(str(og_title_tag['content']), url)
-            elif title_tag := soup.find('title'):
-                assert not isinstance(title_tag, NavigableString)
-                out["title"] = clean_title(title_tag.string, url)
-
-            og_description = (
-                soup.find("meta", attrs={"property": "og:description"}) or
-                soup.find("meta", attrs={"name": "og:description"}) or
-                soup.find("meta", attrs={"name": "description"})
-            )
-
-            if og_description:
-                assert not isinstance(og_description, NavigableString)
-                out["desc"] = clean_description(og_description.attrs.get("content"), url)
-            elif og_description:
-                log.warning(f"description was not a tag: {og_description}")
-
-            out = cast(site_info, dict_filter_falsy(cast(dict, out)))
-            log.debug(f"fetched site {url} : {out}")
-            return out
-
-        except httpx.HTTPStatusError as e:
-            base_msg = f"{e.response.status_code} {e.response.reason_phrase}"
-            msg = f"error fetching {url}:\n{base_msg}"
-            # if e.response.text:
-            #     msg += "\n" + e.response.text
-            log.error(msg)
-            return {"error": base_msg}
-        except httpx.HTTPError as e:
-            e_with_type = ": ".join(i for i in [e.__class__.__name__, str(e)] if i)
-            msg = f"error fetching {url}:\n{e_with_type}"
-            log.error(msg)
-            return {"error": e_with_type}
-
-async def check_and_fetch(rec: dict[str, Any], threshold: float = 0) -> dict[str, site_info] | None:
+async def fetch_site_meta(url: str, prev: site_info | None = None) -> site_info:
+    """
+    Args:
+        prev (site_info | None): the last fetch's result. if it has validators, the request is conditional and a 304 returns prev's metadata unchanged
+    """
+    try:
+        headers = {header: prev[key] for key, header in validator_headers.items() if prev and not prev.get("error") and prev.get(key)}
+        host = httpx.URL(url).host
+        host_scheduler = scheduler.get()
+        for attempt in itertools.count():
+            async with host_scheduler.slot(host), c.get().stream("GET", url, headers=headers) as response:
+                if response.status_code in backoff_statuses and attempt < FETCH_SITE_RETRIES:
+                    host_scheduler.back_off(host, response, attempt)
+                    continue
+                if response.status_code == httpx.codes.NOT_MODIFIED and prev:
+                    log.debug(f"site {url} not modified")
+                    return cast(site_info, {k: v for k, v in prev.items() if k in ("title", "desc", *validator_headers)})
+                response.raise_for_status()
+                check_response(response)
+                head = await read_head(response)
+            break
+        if (canonical := normalize_url(str(response.url))) != (normal_url := normalize_url(url)):
+            # a sqlite write, so it goes to a thread instead of holding up every fetch in flight
+            await asyncio.to_thread(canonical_urls.set, normal_url, canonical)
+        out = await parse_in_pool(head, url)
+        if etag := response.headers.get("etag"):
+            out["etag"] = etag
+        if last_modified := response.headers.get("last-modified"):
+            out["last_modified"] = last_modified
+        log.debug(f"fetched site {url} : {out}")
+        return out
+
+    except httpx.HTTPStatusError as e:
+        base_msg = f"{e.response.status_code} {e.response.reason_phrase}"
+        msg = f"error fetching {url}:\n{base_msg}"
+        # if e.response.text:
+        #     msg += "\n" + e.response.text
+        log.error(msg)
+        return {"error": base_msg}
+    except httpx.HTTPError as e:
+        e_with_type = ": ".join(i for i in [e.__class__.__name__, str(e)] if i)
+        msg = f"error fetching {url}:\n{e_with_type}"
+        log.error(msg)
+        return {"error": e_with_type}
+
+def schedule_next_poll(prev: site_info, new: site_info):
+    """
+    sets new's poll_interval from how the site has behaved: it halves when the title or description changed and grows by half when they didn't,
+    within SITE_POLL_MIN_DAYS and SITE_POLL_MAX_DAYS. erroring sites back off exponentially up to SITE_POLL_ERROR_MAX_DAYS
+    """
+    interval = prev.get("poll_interval", SITE_POLL_MIN_DAYS)
+    if new.get("error"):
+        new["error_streak"] = streak = prev.get("error_streak", 0) + 1
+        interval = min(SITE_POLL_MIN_DAYS * 2 ** streak, SITE_POLL_ERROR_MAX_DAYS)
+    elif prev.get("error"):
+        interval = SITE_POLL_MIN_DAYS # it's back, so check that it stays up
+    elif any(prev.get(k) != new.get(k) for k in ("title", "desc")):
+        interval /= 2
+    else:
+        interval *= 1.5
+    new["poll_interval"] = round(max(SITE_POLL_MIN_DAYS, min(interval, SITE_POLL_MAX_DAYS)), 2)
+
+async def check_and_fetch(rec: dict[str, Any], threshold: float | None = None) -> dict[str, site_info] | None:
+    """
+    Args:
+        threshold (float | None): days since the last poll after which the site is fetched again. defaults to the site's own poll_interval
+    """
     names: dict[str, site_info] = rec[names_col]
-    if check_stale(names.get(site_source_name, {}).get("last_polled"), threshold):
-        new_meta = await fetch_site_meta(rec["url"])
+    prev = names.get(site_source_name, {})
+    if check_stale(prev.get("last_polled"), prev.get("poll_interval", 0) if threshold is None else threshold):
+        new_meta = await fetch_site_meta(rec["url"], prev)
+        schedule_next_poll(prev, new_meta)
         new_meta["last_polled"] = datetime.now(UTC).isoformat(timespec="minutes")
         new_meta["normalized_url"] = rec[kf.NORMAL_URL]
         return deepcopy(names) | {site_source_name: new_meta}
@@ -110,31 +243,123 @@ def url_not_exluded(rec):
     if not any(i.search(url) for i in excluded_regexes):
         return url
 
+class CrawlJournal:
+    """
+    append-only jsonl of the sites a run has fetched and what came of it, so a killed run can pick up where it stopped.
+    one per `key` (the grist doc), locked while a run has it open so concurrent runs on the same doc can't interleave. removed when a run finishes without error
+    """
+    def __init__(self, key: str, journal_dir: str | None = None):
+        """journal_dir defaults to FETCH_SITE_JOURNAL_DIR"""
+        self.path = os.path.join(journal_dir or FETCH_SITE_JOURNAL_DIR, f"atpt_fetch_site_meta_{re.sub(r'[^\w-]', '_', key)}.jsonl")
+        self.entries: dict[str, dict[str, Any]] = {}
+        self._file = open(self.path, "a+")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            raise RuntimeError(f"another fetch_site_meta run is using {self.path}")
+        if time.time() - os.path.getmtime(self.path) < FETCH_SITE_JOURNAL_MAX_AGE:
+            self._file.seek(0)
+            for line in self._file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # blank, or cut off by the kill
+                self.entries[entry["url"]] = entry
+        if self.entries:
+            log.info(f"resuming from {self.path}: {len(self.entries)} sites already fetched")
+        else:
+            self._file.truncate(0)
+        self._file.write("\n") # in case the last run died mid-line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.remove(self.path)
+
+    def record(self, url: str, outcome: Literal["changed", "unchanged", "error"], names: dict[str, site_info] | None = None):
+        self._file.write(json.dumps({"url": url, "outcome": outcome, "names": names}) + "\n")
+        self._file.flush()
+
+async def write_back(g: CustomGrister, queue: asyncio.Queue[dict[str, Any] | None], reported: set[str]) -> list[dict[str, Any]]:
+    """
+    writes the records put on the queue to Sites every FETCH_SITE_FLUSH_ROWS records or FETCH_SITE_FLUSH_SECONDS, until it gets a None.
+    returns the written site_infos of the urls in `reported` (which must be added before their record is queued). the rest aren't kept, so memory stays bounded by the queue
+    """
+    written: list[dict[str, Any]] = []
+    batch: list[dict[str, Any]] = []
+    deadline = time.monotonic() + FETCH_SITE_FLUSH_SECONDS
+    done = False
+    while not done:
+        try:
+            if (rec := await asyncio.wait_for(queue.get(), max(0, deadline - time.monotonic()))) is None:
+                done = True
+            else:
+                batch.append(rec)
+        except TimeoutError:
+            pass
+        if done or len(batch) >= FETCH_SITE_FLUSH_ROWS or time.monotonic() >= deadline:
+            if batch:
+                await asyncio.to_thread(g.add_update_records, "Sites", batch)
+                log.info(f"wrote {len(batch)} sites")
+                written += [rec[gf.FIELDS][names_col][site_source_name] | rec[gf.KEY] for rec in batch if rec[gf.KEY][kf.NORMAL_URL] in reported]
+                batch = []
+            deadline = time.monotonic() + FETCH_SITE_FLUSH_SECONDS
+    return written
+
 async def _main():
     g = ATPTGrister(False)
-    recs = {url: rec for rec in g.list_records("Sites")[1] if (url := url_not_exluded(rec))}
-    raw_metas = {
-        url: nm
-        for meta in asyncio.as_completed([
-            (check_and_fetch(rec)) for rec in recs.values()
-        ])
-        if (nm := await meta)
-        and (diff :=
-            dicts_diff(
-                recs[(url := nm[site_source_name].pop(kf.NORMAL_URL))][names_col][site_source_name], # yeag..
-                nm[site_source_name],
-                "last_polled",
-            )
-        )
-    }
-    new_names = [{
-            gf.KEY: {kf.NORMAL_URL: url},
-            gf.FIELDS: {names_col: nm},
-        } for url, nm in raw_metas.items()]
-    if new_names:
-        for batch in batched(deepcopy(new_names), 100):
-            g.add_update_records("Sites", batch)
-        return {"table-row-object": [rec[gf.FIELDS][names_col][site_source_name] | rec[gf.KEY] for rec in new_names]}
+    recs = {url: rec for rec in g.read_table("Sites", [kf.NORMAL_URL, "url", names_col]) if (url := url_not_exluded(rec))}
+    with CrawlJournal(g._config["GRIST_DOC_ID"]) as journal:
+        # results are written as they come in, so an interrupted run keeps what it finished
+        queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue(FETCH_SITE_FLUSH_ROWS * 2)
+        reported: set[str] = set() # sites whose metadata changed or errored, which are all the run's output shows
+        writer = asyncio.create_task(write_back(g, queue, reported))
+
+        async def put(item: dict[str, Any] | None):
+            # don't block forever on a full queue if the writer died
+            put_task = asyncio.create_task(queue.put(item))
+            await asyncio.wait([put_task, writer], return_when=asyncio.FIRST_COMPLETED)
+            if not put_task.done():
+                put_task.cancel()
+                writer.result()
+
+        try:
+            for url, entry in journal.entries.items():
+                # the previous run may have died before writing these. upserting them again is harmless
+                if entry["names"] and url in recs:
+                    if entry["outcome"] != "unchanged":
+                        reported.add(url)
+                    await put({gf.KEY: {kf.NORMAL_URL: url}, gf.FIELDS: {names_col: entry["names"]}})
+
+            for meta in asyncio.as_completed([check_and_fetch(rec) for url, rec in recs.items() if url not in journal.entries]):
+                if not (nm := await meta):
+                    continue
+                url = nm[site_source_name].pop(kf.NORMAL_URL)
+                if nm[site_source_name].get("error"):
+                    outcome = "error"
+                elif dicts_diff(recs[url][names_col][site_source_name], nm[site_source_name], poll_bookkeeping_keys):
+                    outcome = "changed"
+                else:
+                    outcome = "unchanged"
+                if outcome != "unchanged":
+                    reported.add(url)
+                # every poll is written, even an unchanged one, so its timestamp and validators stick and the site isn't due again next run
+                journal.record(url, outcome, nm)
+                await put({
+                    gf.KEY: {kf.NORMAL_URL: url},
+                    gf.FIELDS: {names_col: nm},
+                })
+            await put(None)
+            written = await writer
+        finally:
+            writer.cancel()
+            await asyncio.to_thread(shutdown_parse_pool)
+    if written:
+        return {"table-row-object": written}
 
 def main():
     return asyncio.run(_main())
@@ -1,14 +1,16 @@
 import asyncio
+import os
 from enum import StrEnum
 from time import time
 from typing import Any, Iterable, Sequence
 from f.main.ATPTGrister import ATPTGrister, check_stale, t, kf, gf, mf
 from itertools import batched
-import httpx
 
 from f.main.boilerplate import dicts_diff
+from f.main.http_clients import async_client
 
-c = httpx.AsyncClient()
+BSKY_API_CONCURRENT_CONNECTIONS = int(os.environ.get("BSKY_API_CONCURRENT_CONNECTIONS", 5))
+c = async_client(BSKY_API_CONCURRENT_CONNECTIONS)
 
 class af(StrEnum):
     CAKEDAY = "createdAt"
@@ -19,7 +21,6 @@ class af(StrEnum):
     POSTS = "postsCount"
 
 
-# BSKY_API_CONCURRENT_CONNECTIONS = int(os.environ.get("BSKY_API_CONCURRENT_CONNECTIONS", 5))
 # sem = asyncio.Semaphore(BSKY_API_CONCURRENT_CONNECTIONS)
 
 batch_size = 25 # getProfiles api limit
@@ -69,7 +70,7 @@ async def _main():
     g = ATPTGrister(fetch_authors=False)
     stale_authors = {
         fields[kf.DID]: fields for fields in
-        g.list_records(t.AUTHORS)[1]
+        g.read_table(t.AUTHORS)
         if check_stale(fields.get(mf.POLLED), 0)
     }
     if not stale_authors:
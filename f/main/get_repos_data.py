@@ -1,17 +1,21 @@
 from datetime import datetime
 from enum import StrEnum
-from typing import Any, Iterable
+from typing import Any, Iterable, cast
 from urllib.parse import urlparse, urlunparse
 import asyncio
+import os
 import httpx
 import pprint
 import re
-from f.main.ATPTGrister import ATPTGrister, CustomGrister, make_timestamp, t, kf, mf, check_stale
+import time
+import zlib
+from f.main.ATPTGrister import ATPTGrister, CustomGrister, make_timestamp, normalize_url, t, kf, mf, check_stale
+from f.main.canonical_urls import canonical_urls
 from at_url_converter import lex, url_obj, at_url, atproto_utils
-from f.main.boilerplate import batched, dicts_diff, error_with_type, get_timed_logger
+from f.main.boilerplate import dicts_diff, error_with_type, get_timed_logger
 from operator import itemgetter as getter
-from httpx import AsyncClient
-from github_client import gh_client, gh_graphql
+from f.main.http_clients import async_client
+from github_client import GraphQLBatcher, gh_budget, gh_get_conditional, gh_graphql
 from atproto.exceptions import AtProtocolError
 from constellation import all_links as constellation_links
 
@@ -46,7 +50,7 @@ ref_field_names = {
     rt.LANGUAGES: "language"
 }
 
-c = AsyncClient(timeout=30, follow_redirects=True)
+c = async_client(timeout=30, follow_redirects=True)
 
 async def get_tangled_rec(url: str):
     u = url_obj(url)
@@ -110,6 +114,7 @@ def extract_readme_header(text: str) -> str | None:
 
 fragment_def = """
 fragment repoProperties on Repository {
+  url
   homepageUrl
   description
   isArchived
@@ -176,14 +181,129 @@ fragment repoProperties on Repository {
   }
 }
 """
+state_fragment_def = """
+fragment repoState on Repository {
+  url
+  homepageUrl
+  description
+  isArchived
+  pushedAt
+  defaultBranchRef {
+      target {
+        ... on Commit {
+          oid
+          committedDate
+        }
+      }
+    }
+  forkCount
+  stargazerCount
+  issues(states: OPEN) {
+    totalCount
+  }
+  pullRequests(states: OPEN) {
+    totalCount
+  }
+}
+"""
+"""the cheap part of repoProperties (no blobs or node lists), enough to tell whether a repo changed"""
+
 template = (
-    """{id}: repository(owner: "{owner}", name: "{repo}") {{...repoProperties}}"""
+    """{id}: repository(owner: "{owner}", name: "{repo}") {{...{fragment}}}"""
 )
 
 rate_limit_info = "rateLimit {cost remaining resetAt}"
 
 poll_timestamp = int(datetime.today().timestamp())
 
+GITHUB_FULL_REFRESH_DAYS = int(os.environ.get("GITHUB_FULL_REFRESH_DAYS", 7))
+"""topics, readmes, owner accounts etc can change without a push, so every repo still gets the full query about once every this many days"""
+
+def repo_changed(url: str, old_rec: dict[str, Any], state: dict[str, Any]) -> bool:
+    """whether a repo needs the full repoProperties query, going by its repoState and its record from the last poll"""
+    if not old_rec.get(mf.POLLED) or old_rec.get(mf.STATUS) == "not found":
+        return True
+    if zlib.crc32(url.encode()) % GITHUB_FULL_REFRESH_DAYS == poll_timestamp // (24 * 60 * 60) % GITHUB_FULL_REFRESH_DAYS:
+        return True # the periodic full refreshes are spread out over the days
+    if (pushed_at := state.get("pushedAt")) and make_timestamp(pushed_at) > make_timestamp(old_rec[mf.POLLED]):
+        return True
+    # updatedAt is the date of the default branch's head commit, so it changes along with the oid
+    commit = (state.get("defaultBranchRef") or {}).get("target") or {}
+    return bool(commit) and make_timestamp(commit["committedDate"]) != old_rec.get("updatedAt")
+
+GITHUB_GRAPHQL_CONCURRENCY = int(os.environ.get("GITHUB_GRAPHQL_CONCURRENCY", 4))
+"""graphql batches in flight at once. they still go out at most one per GITHUB_GRAPHQL_COOLDOWN, which keeps them under github's secondary limits"""
+
+async def query_repos(repos: list[tuple[str, str]], fragment_def: str, fragment: str, batch_size: int) -> dict[int, dict[str, Any] | None]:
+    """
+    queries a graphql fragment on each (owner, repo), in adaptively sized batches. up to GITHUB_GRAPHQL_CONCURRENCY batches are in flight at once,
+    held back only when the graphql point budget (gh_budget) can't cover them
+
+    Returns:
+        dict[int, dict[str, Any] | None]: results by index in repos, None for the ones that weren't found. repos whose queries kept failing are left out
+    """
+    batcher = GraphQLBatcher(repos, batch_size)
+
+    async def send(batch: list[tuple[str, tuple[str, str]]]):
+        repos_query_batch = "\n".join(
+            template.format(id=alias, owner=owner, repo=repo, fragment=fragment)
+            for alias, (owner, repo) in batch
+        )
+        cost = batcher.estimated_cost(batch)
+        await gh_budget.reserve(cost)
+        rate_limit: dict[str, Any] = {}
+        try:
+            start = time.monotonic()
+            try:
+                response = await gh_graphql(f"{fragment_def} {{{repos_query_batch} {rate_limit_info}}}")
+            except httpx.TransportError:
+                response = None
+            rate_limit = batcher.handle(batch, response, time.monotonic() - start)
+        finally:
+            gh_budget.release(cost, rate_limit) # also when cancelled or on an unexpected error, or the points would stay held for the rest of the process
+
+    in_flight: set[asyncio.Task] = set()
+    try:
+        while True:
+            # failed batches go back into the batcher, so it can have more to hand out after a request finishes
+            while len(in_flight) < GITHUB_GRAPHQL_CONCURRENCY and (batch := batcher.next_batch()):
+                in_flight.add(asyncio.create_task(send(batch)))
+            if not in_flight:
+                return batcher.results
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+    finally:
+        # only left over if a batch raised (or this was cancelled). don't leave them running unawaited
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+GITHUB_CONTRIBUTORS_CONCURRENCY = int(os.environ.get("GITHUB_CONTRIBUTORS_CONCURRENCY", 8))
+
+async def count_contributors(owner: str, repo: str) -> int | None:
+    # https://docs.github.com/en/rest/repos/repos?apiVersion=2022-11-28#list-repository-contributors
+    # with one contributor per page, the number of the last page is the contributor count
+    contribs = f"https://api.github.com/repos/{owner}/{repo}/contributors?per_page=1"
+    def from_response(contribs_resp: httpx.Response) -> int:
+        if (link := contribs_resp.headers.get("link")) and (last_link_match := re.search(r'<([^\s]*?)>; rel="last"', link)):
+            contribs_last_page = last_link_match[1]
+            page_count = url_obj(contribs_last_page).find_query_param("page")
+            if not page_count:
+                raise ValueError(f"last page count param not found in link {contribs_last_page}")
+            return int(page_count)
+        return len(contribs_resp.json()) if contribs_resp.content else 0
+    # a failed count only leaves the repo's contributors field as it was, so none of these should take down the rest of the run
+    try:
+        contribs_count = await gh_get_conditional(contribs, from_response)
+    except (httpx.HTTPError, ValueError) as e:
+        log.error(f"could not count contributors of https://github.com/{owner}/{repo}:\n{error_with_type(e)}")
+        return None
+    if not contribs_count:
+        log.warning(f"no contributors listed for https://github.com/{owner}/{repo}, it's probably empty") # github answers 204 for an empty repo
+        return None
+    return contribs_count
+
 async def fetch_repo_data(g: CustomGrister, repo_urls: Iterable[kf], old_records: dict[kf, dict[str, Any]] = {}) -> dict[kf, dict[str, Any]]:
     """
     fills in repo metadata to the Repos table. Quite slow - it reads/writes 3 additional tables (listed in the rt enum)
@@ -197,7 +317,7 @@ async def fetch_repo_data(g: CustomGrister, repo_urls: Iterable[kf], old_records
     if not repo_urls:
         return {}
     if not old_records:
-        old_records  = {rec[kf.NORMAL_URL]: rec for rec in g.list_records(t.REPOS)[1]}
+        old_records  = {rec[kf.NORMAL_URL]: rec for rec in g.read_table(t.REPOS)}
     records = {}
     ref_trackers = {}
     #TODO make these list requests async
@@ -277,28 +397,39 @@ async def fetch_repo_data(g: CustomGrister, repo_urls: Iterable[kf], old_records
         for url in repo_urls
         if (rmatch := re.search(r"https://github\.com/([^/]*)/([^/]*)/?$", url))
     ]
-    github_responses: dict[str, dict[str, Any]] = {}
-    batch_size = 32
-    # 100 is the stated limit in the docs, but it still timed out server-side a fair bit. experimentally 64 seems to work better.
-    # 32 when also fetching readme files
-    for num_req, batch in enumerate(batched(github_urls, batch_size)): 
-        repos_query_batch = "\n".join(
-            template.format(id="r" + str(num_req * batch_size + i), owner=owner, repo=repo)
-            for i, (owner, repo) in enumerate(batch)
-        )
-        response = gh_graphql(f"{fragment_def} {{{repos_query_batch} {rate_limit_info}}}")
-        data = response.json()["data"]
-        log.debug(pprint.pformat(data.pop("rateLimit")))
-        if errors := data.pop("errors", None):
-            log.error(pprint.pformat(errors))
-        github_responses |= data
-
-    for (owner, repo), resp in zip(github_urls, github_responses.values()):
+    # a cheap pass over every repo first, then the full fragment only for the ones that changed since they were last polled
+    # starting batch sizes, which then adapt to how the queries go. 100 is the stated limit in the docs, but it still timed out server-side a fair bit.
+    # experimentally 64 seems to work better, 32 when also fetching readme files
+    github_states = await query_repos(github_urls, state_fragment_def, "repoState", 64)
+    changed: list[int] = []
+    for i, state in github_states.items():
+        url = "https://github.com/{}/{}".format(*github_urls[i])
+        if state and repo_changed(url, old_records.get(cast(kf, url), {}), state):
+            changed.append(i)
+    github_responses = dict(github_states)
+    for j, resp in (await query_repos([github_urls[i] for i in changed], fragment_def, "repoProperties", 32)).items():
+        github_responses[changed[j]] = resp or github_responses[changed[j]] # keep the cheap result if the full query failed for this one
+    log.info(f"{len(changed)}/{len(github_urls)} github repos changed since they were last polled")
+
+    # resolve the linked bluesky accounts concurrently up front, g.resolve_author in the loop below then reads them from the cache
+    await g.resolve_identities(
+        acc["url"]
+        for resp in github_responses.values() if resp
+        for acc in ((resp.get("owner") or {}).get("socialAccounts") or {}).get("nodes", [])
+        if acc["provider"] == "BLUESKY"
+    )
+    to_count: dict[str, tuple[str, str]] = {}
+    """url -> (owner, repo) of the repos whose contributors get counted again. the requests are only made once the loop is done"""
+    for i, resp in github_responses.items():
+        owner, repo = github_urls[i]
         url = f"https://github.com/{owner}/{repo}"
         out: dict[str, Any] = {
             mf.POLLED: poll_timestamp
         }
         if resp:
+            # github answers for a renamed or transferred repo under its new address, remember it so the collector can fold the old one in
+            if repo_url := resp.get("url"):
+                canonical_urls.set(normalize_url(url), normalize_url(repo_url))
             for field, v in resp.items():
                 if not v:
                     continue
@@ -347,30 +478,24 @@ async def fetch_repo_data(g: CustomGrister, repo_urls: Iterable[kf], old_records
                     case "readme" | "README":
                         if v and (text := v["text"]):
                             out["readme_header"] = extract_readme_header(text)
-            # https://docs.github.com/en/rest/repos/repos?apiVersion=2022-11-28#list-repository-contributors
-            contribs = f"https://api.github.com/repos/{owner}/{repo}/contributors?per_page=100"
-            contribs_resp = gh_client.get(contribs)
-            contribs_data = contribs_resp.json()
-            contribs_count: int | None = None
-            if (link := contribs_resp.headers.get("link")) and (last_link_match := re.search(r'<([^\s]*?)>; rel="last"', link)):
-                contribs_last_page = last_link_match[1]
-                page_count = url_obj(contribs_last_page).find_query_param("page")
-                if not page_count:
-                    raise ValueError(f"last page count param not found in link {contribs_last_page}")
-                contribs_count = (int(page_count) - 1) * 100
-                contribs_resp = gh_client.get(contribs_last_page)
-                contribs_data = contribs_resp.json()
-                contribs_count += len(contribs_data)
+            old_rec = old_records.get(url, {})
+            if old_rec.get("contributors") and out.get("updatedAt") and old_rec.get("updatedAt") == out["updatedAt"]:
+                out["contributors"] = old_rec["contributors"] # no new commits on the default branch, so no new contributors either
             else:
-                contribs_count = len(contribs_data)
-            if contribs_count is not None:
-                if contribs_count == 0:
-                    raise ValueError(f"found 0 contributors for the extant repo https://github.com/{owner}/{repo}")
-                out["contributors"] = contribs_count
+                to_count[url] = (owner, repo)
         else:
             out[mf.STATUS] = "not found"
         records[url] = out
 
+    contributors_sem = asyncio.Semaphore(GITHUB_CONTRIBUTORS_CONCURRENCY)
+    async def bounded_count(owner: str, repo: str):
+        async with contributors_sem:
+            return await count_contributors(owner, repo)
+    for url, count in zip(to_count, await asyncio.gather(*(bounded_count(*owner_repo) for owner_repo in to_count.values()))):
+        if count is not None:
+            records[url]["contributors"] = count
+    log.info(f"counted contributors of {len(to_count)}/{len(github_urls)} github repos, the rest had no new commits or weren't found")
+
     g.write_authors()
     ref_trackers[t.AUTHORS]["old"] = g.authors_lookup
     ref_trackers[t.AUTHORS]["new"].clear()
@@ -396,7 +521,7 @@ async def fetch_repo_data(g: CustomGrister, repo_urls: Iterable[kf], old_records
 async def update_all_repos(g: CustomGrister | None = None, include_inactive: bool = True, stale_threshold = 2):
     g = g or ATPTGrister(fetch_authors=True)
     #TODO convert to sql query
-    old_records_dict = {rec[kf.NORMAL_URL]: rec for rec in g.list_records("Repos")[1]}
+    old_records_dict = {rec[kf.NORMAL_URL]: rec for rec in g.read_table(t.REPOS)}
     urls = [
         i[kf.NORMAL_URL]
         for i in old_records_dict.values()
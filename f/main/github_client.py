@@ -1,18 +1,54 @@
+import asyncio
+from collections import Counter, deque
+from datetime import datetime
+import math
+import os
+import re
 from pprint import pformat
 from string import Template
-from typing import Any
+from typing import Any, Callable
 import wmill
-from f.main.boilerplate import get_timed_logger, batched, url_obj
+from f.main.boilerplate import LoopLocal, get_timed_logger, url_obj
 import time
 import httpx
+from f.main.http_clients import async_transport, transport
+from f.main.sqlite_cache import SqliteCache, cache_path
 
 log = get_timed_logger(__name__)
 
+GITHUB_REST_COOLDOWN = float(os.environ.get("GITHUB_REST_COOLDOWN", 0.1))
+"""seconds between rest requests sent through gh_async_client. 0.1 keeps them under the secondary limit of 900 points a minute"""
+GITHUB_GRAPHQL_COOLDOWN = float(os.environ.get("GITHUB_GRAPHQL_COOLDOWN", 1))
+"""
+seconds between graphql requests sent through gh_async_client, paced apart from rest calls.
+big batched queries run for seconds each on github's end, and the secondary limits allow only 60s of graphql server time per minute
+"""
+GITHUB_BATCH_TARGET_SECONDS = float(os.environ.get("GITHUB_BATCH_TARGET_SECONDS", 5))
+"""graphql batches are sized to take about this long. github gives up on queries after 10s"""
+GITHUB_BATCH_RETRIES = int(os.environ.get("GITHUB_BATCH_RETRIES", 3))
+GITHUB_ETAG_CACHE_PATH = os.environ.get("GITHUB_ETAG_CACHE_PATH", cache_path("github_etags"))
+
 # https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api?apiVersion=2022-11-28#about-secondary-rate-limits
+def rate_limit_wait(response: httpx.Response) -> float:
+    """seconds to wait before retrying if the response hit a github rate limit, else 0"""
+    headers = response.headers
+    if int(headers.get("x-ratelimit-remaining", 0)) == 0:
+        reset_time = int(headers.get("x-ratelimit-reset", 0))
+        # Calculate wait time
+        wait_time = reset_time - time.time()
+        if wait_time > 0:
+            log.warning(f"Primary github rate limit hit. Waiting {wait_time:.2f} seconds. response body:\n{response.json()}")
+            return wait_time + 1  # Add 1 second buffer
+
+    if (retry_after := int(headers.get("retry-after", 0))) > 0:
+        log.warning(f"Secondary github rate limit hit. Waiting {retry_after} seconds. response body:\n{response.json()}")
+        return retry_after + 1
+    return 0
+
 class GitHubRateLimitRetryTransport(httpx.BaseTransport): # thank u claude
     # https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api#staying-under-the-rate-limit
     def __init__(self, cooldown: float = 1):
-        self.main_transport = httpx.HTTPTransport()
+        self.main_transport = transport()
         self.cooldown = cooldown  # hopefully the cooldown lets us avoid hitting rate limit?
         self.last_request_time = 0
 
@@ -25,44 +61,122 @@ class GitHubRateLimitRetryTransport(httpx.BaseTransport): # thank u claude
                     log.debug(f"cooldown: waiting {to_sleep:.2f}s")
                     time.sleep(to_sleep)
             
+            sent_at = time.monotonic()
             response = self.main_transport.handle_request(request)
             response.read()
+            response.extensions["round_trip"] = time.monotonic() - sent_at
             self.last_request_time = time.time()
 
-            headers = response.headers
+            if wait_time := rate_limit_wait(response):
+                time.sleep(wait_time)
+                continue
 
-            if int(headers.get("x-ratelimit-remaining", 0)) == 0:
-                reset_time = int(headers.get("x-ratelimit-reset", 0))
-                # Calculate wait time
-                wait_time = reset_time - time.time()
-                if wait_time > 0:
-                    log.warning(f"Primary github rate limit hit. Waiting {wait_time:.2f} seconds. response body:\n{response.json()}")
-                    time.sleep(wait_time + 1)  # Add 1 second buffer
-                    continue
+            # If we get here, either we're not rate limited or we've waited and should return the response
+            return response
+
+class AsyncGitHubRateLimitRetryTransport(httpx.AsyncBaseTransport):
+    """
+    async version of GitHubRateLimitRetryTransport. waits with asyncio.sleep, so other requests on the event loop carry on.
+    like the sync one, it puts how long the final attempt itself took (without the cooldowns and rate limit waits) in response.extensions["round_trip"].
+    rest and graphql requests are paced separately, each with its own cooldown. the pauses are shared by all the requests in flight on the same api:
+    a rate limit hit by one holds back the rest until it resets
+    """
+    def __init__(self, cooldown: float = 1, graphql_cooldown: float | None = None):
+        self.main_transport = async_transport()
+        self.cooldowns = {"rest": cooldown, "graphql": cooldown if graphql_cooldown is None else graphql_cooldown}
+        self.next_request_time = {api: 0.0 for api in self.cooldowns}
+        """earliest time the next request to each api may be sent"""
+
+    @staticmethod
+    def api(request: httpx.Request) -> str:
+        return "graphql" if request.url.path == "/graphql" else "rest"
+
+    async def _wait_turn(self, api: str):
+        # no lock needed, the event loop is single threaded and this claims a send time before awaiting anything
+        now = time.time()
+        send_at = max(now, self.next_request_time[api])
+        self.next_request_time[api] = send_at + self.cooldowns[api]
+        if send_at > now:
+            log.debug(f"{api} cooldown: waiting {send_at - now:.2f}s")
+            await asyncio.sleep(send_at - now)
+
+    async def handle_async_request(self, request):
+        api = self.api(request)
+        while True:
+            await self._wait_turn(api)
+            sent_at = time.monotonic()
+            response = await self.main_transport.handle_async_request(request)
+            await response.aread()
+            response.extensions["round_trip"] = time.monotonic() - sent_at
 
-            if (retry_after := int(headers.get("retry-after", 0))) > 0:
-                log.warning(f"Secondary github rate limit hit. Waiting {retry_after} seconds. response body:\n{response.json()}")
-                time.sleep(retry_after + 1)
+            if wait_time := rate_limit_wait(response):
+                self.next_request_time[api] = max(self.next_request_time[api], time.time() + wait_time)
                 continue
 
-            # If we get here, either we're not rate limited or we've waited and should return the response
             return response
 
+    async def aclose(self):
+        await self.main_transport.aclose()
+
+gh_headers = {
+    "Authorization": f"Bearer {wmill.get_variable('u/autumn/github_key')}",
+    "Content-Type": "application/json",
+}
+
 gh_client = httpx.Client(
-    headers={
-        "Authorization": f"Bearer {wmill.get_variable('u/autumn/github_key')}",
-        "Content-Type": "application/json",
-    },
+    headers=gh_headers,
     transport=GitHubRateLimitRetryTransport(),
     timeout = 30,
     follow_redirects=True
 )
 
-def gh_graphql(query: str):
-    return gh_client.post("https://api.github.com/graphql", json={"query": query})
+gh_async_client = LoopLocal(lambda: httpx.AsyncClient(
+    headers=gh_headers,
+    transport=AsyncGitHubRateLimitRetryTransport(GITHUB_REST_COOLDOWN, GITHUB_GRAPHQL_COOLDOWN),
+    timeout = 30,
+    follow_redirects=True
+))
+
+async def gh_graphql(query: str):
+    return await gh_async_client.get().post("https://api.github.com/graphql", json={"query": query})
+
+etag_cache = SqliteCache(GITHUB_ETAG_CACHE_PATH)
+"""url -> [etag, value derived from the response] for github rest responses"""
+
+async def gh_get_conditional[T](url: str, derive: Callable[[httpx.Response], T]) -> T:
+    """
+    GETs a github rest endpoint with the etag of the last response, if there was one. a 304 (which doesn't count against the rate limit) returns the value derived last time.
+
+    Args:
+        derive (Callable[[httpx.Response], T]): turns a fresh response into the value that gets cached. must return something json serializable
+    """
+    _, cached = etag_cache.get(url)
+    response = await gh_async_client.get().get(url, headers={"If-None-Match": cached[0]} if cached else {})
+    if response.status_code == httpx.codes.NOT_MODIFIED and cached:
+        log.debug(f"{url} not modified")
+        return cached[1]
+    response.raise_for_status()
+    value = derive(response)
+    if etag := response.headers.get("etag"):
+        etag_cache.set(url, [etag, value])
+    return value
 
 rate_limit_info = "rateLimit {cost remaining resetAt}"
 
+permanent_error_types = {"NOT_FOUND", "FORBIDDEN", "UNPROCESSABLE"}
+"""graphql error types that retrying won't fix"""
+
+def is_query_error(response: httpx.Response | None, body: dict[str, Any]) -> bool:
+    """
+    whether a response without data means the query itself is bad (a syntax error, an unknown field...), which no retry or smaller batch will fix.
+    those errors aren't tied to any selection, so they have no path. timeouts don't have one either, but they say so
+    """
+    errors = body.get("errors") or []
+    return (
+        response is not None and not response.is_server_error and bool(errors)
+        and not any(error.get("path") or re.search(r"time(d)? ?out", error.get("message", ""), re.IGNORECASE) for error in errors)
+    )
+
 outer_template = Template('''
 query {
   repository(owner: "$owner", name: "$repo") {
@@ -74,6 +188,142 @@ query {
 
 line_template = Template('$id: object(expression: "$branch:$path") { ... on Blob { text } }')
 
+class GraphQLBatcher[T]:
+    """
+    splits items into graphql requests of aliased selections (r0, r1, ...), with a batch size that adapts as responses come in:
+    it grows while requests come back well under GITHUB_BATCH_TARGET_SECONDS, shrinks towards it when they're slower, halves on timeouts and server errors,
+    and is capped so one request can't cost more points than the rate limit has left.
+    the items of a failed request are put back to be retried in the smaller batches. an item gives up after failing GITHUB_BATCH_RETRIES times by itself (or with its own error),
+    and a batch github rejects as a bad query (see is_query_error) gives up right away
+
+    usage: take batches from next_batch() until it returns None, and pass each response (None if the request failed without one) to handle()
+    """
+    def __init__(self, items: list[T], batch_size: int, max_batch_size: int = 100, nested_in: tuple[str, ...] = ()):
+        """
+        Args:
+            nested_in (tuple[str, ...]): keys of data the aliases are under, if they aren't top-level fields
+        """
+        self.items = items
+        self.batch_size = min(batch_size, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.nested_in = nested_in
+        self.results: dict[int, Any] = {}
+        """results by item index. items that kept failing are missing, items that don't exist (e.g. deleted repos) are None"""
+        self.cost_per_item = 0.0
+        """graphql points per item, going by the last response's rateLimit.cost"""
+        self._pending: deque[int] = deque(range(len(items)))
+        self._attempts: Counter[int] = Counter()
+
+    def next_batch(self) -> list[tuple[str, T]] | None:
+        """(alias, item) pairs for the next request"""
+        if not self._pending:
+            return None
+        return [(f"r{i}", self.items[i]) for i in (self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending))))]
+
+    def estimated_cost(self, batch: list[tuple[str, T]]) -> int:
+        return max(1, math.ceil(self.cost_per_item * len(batch)))
+
+    def handle(self, batch: list[tuple[str, T]], response: httpx.Response | None, elapsed: float) -> dict[str, Any]:
+        """
+        Args:
+            elapsed (float): how long the request took, for when the response doesn't carry its own round trip time (see AsyncGitHubRateLimitRetryTransport).
+                only the round trip is used to size batches, time spent waiting on cooldowns or rate limits says nothing about the query
+
+        Returns:
+            dict[str, Any]: the response's rateLimit selection, if it had one
+        """
+        ids = [int(alias[1:]) for alias, _ in batch]
+        body: dict[str, Any] = {}
+        if response is not None:
+            elapsed = response.extensions.get("round_trip", elapsed)
+            if not response.is_server_error:
+                try:
+                    body = response.json()
+                except ValueError:
+                    pass
+        if not body.get("data") and is_query_error(response, body):
+            log.error(f"github rejected the query, giving up on {len(batch)} items:\n{pformat(body['errors'])}")
+            return {}
+        if not (data := body.get("data")):
+            log.warning(f"github query for {len(batch)} items failed after {elapsed:.1f}s: {response.status_code if response is not None else 'no response'} {body.get('errors', '')}")
+            self.batch_size = max(1, len(batch) // 2)
+            self.max_batch_size = max(1, len(batch) - 1) # don't grow back into the size that failed
+            if len(batch) > 1:
+                self._pending.extendleft(reversed(ids)) # only count it against an item once it fails on its own
+            else:
+                self._retry(ids)
+            return {}
+
+        rate_limit = data.pop("rateLimit", None) or {}
+        log.debug(f"{len(batch)} items in {elapsed:.1f}s, rate limit: {rate_limit}")
+        retry_aliases = set()
+        for error in body.get("errors", []):
+            error_path = error.get("path") or []
+            if error.get("type") not in permanent_error_types and len(error_path) > len(self.nested_in):
+                retry_aliases.add(error_path[len(self.nested_in)])
+        if errors := body.get("errors"):
+            log.error(f"errors in github query:\n{pformat(errors)}")
+
+        for key in self.nested_in:
+            data = data.get(key) or {}
+        retry = []
+        for alias, i in zip((alias for alias, _ in batch), ids):
+            if alias in retry_aliases and data.get(alias) is None:
+                retry.append(i)
+            else:
+                self.results[i] = data.get(alias)
+        self._retry(retry)
+
+        if retry_aliases:
+            self.batch_size = max(1, len(batch) // 2)
+        elif elapsed > GITHUB_BATCH_TARGET_SECONDS:
+            self.batch_size = max(1, int(len(batch) * GITHUB_BATCH_TARGET_SECONDS / elapsed))
+        elif elapsed < GITHUB_BATCH_TARGET_SECONDS / 2 and len(batch) >= self.batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 3 // 2 + 1)
+        if (cost := rate_limit.get("cost")) and (remaining := rate_limit.get("remaining")) is not None:
+            self.cost_per_item = cost / len(batch)
+            self.batch_size = max(1, min(self.batch_size, int(remaining / self.cost_per_item)))
+        return rate_limit
+
+    def _retry(self, ids: list[int]):
+        retry = []
+        for i in ids:
+            self._attempts[i] += 1
+            if self._attempts[i] > GITHUB_BATCH_RETRIES:
+                log.error(f"giving up on github query for {self.items[i]}")
+            else:
+                retry.append(i)
+        self._pending.extendleft(reversed(retry))
+
+class GraphQLPointBudget:
+    """
+    github's graphql point budget as last reported in a rateLimit selection, shared by concurrent queries.
+    queries go out freely while the points left (minus what the ones in flight are expected to cost) cover them, and wait for the reset when they don't
+    """
+    def __init__(self):
+        self.remaining: int | None = None
+        self.reset_at = 0.0
+        self.in_flight = 0
+
+    async def reserve(self, cost: int):
+        while self.remaining is not None and self.remaining - self.in_flight < cost and (wait := self.reset_at - time.time()) > 0:
+            log.warning(f"graphql point budget used up ({self.remaining} left, {self.in_flight} in flight), waiting {wait:.0f}s for the reset")
+            await asyncio.sleep(wait + 1)
+        self.in_flight += cost
+
+    def release(self, cost: int, rate_limit: dict[str, Any]):
+        """call with the reserved cost once the query is back, along with its rateLimit (empty if it failed)"""
+        self.in_flight -= cost
+        if not rate_limit:
+            return
+        reset_at = datetime.fromisoformat(rate_limit["resetAt"]).timestamp()
+        if reset_at > self.reset_at or self.remaining is None:
+            self.reset_at, self.remaining = reset_at, rate_limit["remaining"]
+        elif reset_at == self.reset_at:
+            self.remaining = min(self.remaining, rate_limit["remaining"]) # responses can come back out of order
+
+gh_budget = GraphQLPointBudget()
+
 def get_repo_files(url: str, paths: list[str], batch_size = 32) -> dict[str, str]:
     
     u = url_obj(url)
@@ -81,29 +331,22 @@ def get_repo_files(url: str, paths: list[str], batch_size = 32) -> dict[str, str
     if not all((owner, repo, branch)):
         raise ValueError('improperly formatted url')
     
-    out: dict[str, str] = {}
-
-    for num_req, batch in enumerate(batched(paths, batch_size)): 
+    batcher = GraphQLBatcher(paths, batch_size, nested_in=("repository",))
+    while batch := batcher.next_batch():
         lines = "\n    ".join(
-            line_template.substitute(id="r" + str(num_req * batch_size + i), branch=branch, path=path)
-            for i, path in enumerate(batch)
+            line_template.substitute(id=alias, branch=branch, path=path)
+            for alias, path in batch
         )
         query = outer_template.substitute(owner=owner, repo=repo, lines=lines, rate_limit_info=rate_limit_info)
 
         log.debug(f'sending github query {query}')
-        response = gh_client.post(
-            "https://api.github.com/graphql", json={"query": query}
-        )
-
-        data: dict[str, Any] = response.json()['data']
-        log.info("rate limit: " + str(data.pop("rateLimit", None)))
-        if errors := data.pop("errors", None):
-            log.error(f"error fetching github files:\n{pformat(errors)}")
-        batch_results = {
-            paths[int(id.strip("r"))]: entry["text"]
-            for id, entry in data["repository"].items()
-        }
-
-        out |= batch_results
+        start = time.monotonic()
+        try:
+            response = gh_client.post(
+                "https://api.github.com/graphql", json={"query": query}
+            )
+        except httpx.TransportError:
+            response = None
+        batcher.handle(batch, response, time.monotonic() - start)
 
-    return out
+    return {paths[i]: entry["text"] for i, entry in batcher.results.items() if entry}
@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Iterator
+from f.main.ATPTGrister import CustomGrister, is_hidden_col, kf
+from f.main.boilerplate import get_timed_logger
+log = get_timed_logger(__name__)
+
+GRIST_MIRROR_MAX_AGE = float(os.environ.get("GRIST_MIRROR_MAX_AGE", 0))
+"""seconds a synced table is served from the local copy without asking grist anything. 0 syncs on every read"""
+
+updated_col = "record_updatedAt"
+"""trigger formula column with the last time a row was changed. tables without it are re-read in full on every sync"""
+
+schema_version = 2
+
+class GristMirror:
+    """
+    local sqlite copy of the grist doc's tables. a sync only sends the rows whose updated_col changed since the last one over the wire,
+    plus the current values of the table's formula columns, which can change without the row being edited.
+    deletions are caught by comparing row counts, so the live ids are only listed when rows actually went away.
+    a change to a table's columns, or a table without updated_col, means a full re-download of that table.
+    """
+    def __init__(self, g: CustomGrister, path: str, max_age: float = GRIST_MIRROR_MAX_AGE):
+        self.g = g
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock() # the collector reads tables from worker threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+                self._db.executescript("DROP TABLE IF EXISTS sync_state; DROP TABLE IF EXISTS records;")
+            self._db.executescript(f"""
+                CREATE TABLE IF NOT EXISTS sync_state (doc_id TEXT, table_id TEXT, cols TEXT, last_updated REAL, synced_at REAL, PRIMARY KEY (doc_id, table_id));
+                CREATE TABLE IF NOT EXISTS records (doc_id TEXT, table_id TEXT, id INTEGER, record TEXT, PRIMARY KEY (doc_id, table_id, id));
+                PRAGMA user_version = {schema_version};
+            """)
+
+    @property
+    def doc_id(self) -> str:
+        return self.g._config["GRIST_DOC_ID"]
+
+    def expire(self, table_id: str):
+        """makes the next read of table_id sync, whatever max_age says. called when this client writes to the table"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE sync_state SET synced_at = 0 WHERE doc_id = ? AND table_id = ?", (self.doc_id, table_id))
+
+    def sync(self, table_id: str) -> int:
+        """brings the local copy of a table up to date. returns the number of rows fetched in full"""
+        key = (self.doc_id, table_id)
+        with self._lock:
+            state = self._db.execute("SELECT cols, last_updated, synced_at FROM sync_state WHERE doc_id = ? AND table_id = ?", key).fetchone()
+        if state and time.time() - state[2] < self.max_age:
+            return 0
+
+        cols = self.g.list_cols(table_id, hidden=True)[1]
+        col_types = {col["id"]: col["fields"]["type"] for col in cols}
+        formula_cols = [col["id"] for col in cols if col["fields"].get("isFormula") and col["fields"].get("formula")]
+        cols_sig = json.dumps(col_types, sort_keys=True)
+        full_sync = not state or state[0] != cols_sig or updated_col not in col_types
+        last_updated = 0 if full_sync else state[1] or 0
+        synced_at = time.time()
+
+        if full_sync:
+            if updated_col not in col_types:
+                log.debug(f"{table_id} has no {updated_col} column, re-reading all of it")
+            fetched = list(self.g.iter_records(table_id, list(col_types), convert=False))
+            formula_values = []
+        else:
+            # >= since several rows can share a timestamp. re-fetching a few unchanged ones is harmless
+            fetched = list(self.g.iter_records(table_id, list(col_types), f'"{updated_col}" >= ?', [last_updated], convert=False))
+            formula_values = list(self.g.iter_records(table_id, formula_cols, convert=False)) if formula_cols else []
+        last_updated = max((rec.get(updated_col) or 0 for rec in fetched), default=last_updated)
+
+        with self._lock, self._db:
+            if full_sync:
+                self._db.execute("DELETE FROM records WHERE doc_id = ? AND table_id = ?", key)
+            fetched_ids = {rec[kf.ID] for rec in fetched}
+            if formula_values:
+                local = dict(self._db.execute("SELECT id, record FROM records WHERE doc_id = ? AND table_id = ?", key).fetchall())
+                changed = []
+                for values in formula_values:
+                    if values[kf.ID] in fetched_ids or (raw := local.get(values[kf.ID])) is None:
+                        continue
+                    rec = json.loads(raw)
+                    if any(rec.get(k) != v for k, v in values.items()):
+                        changed.append(rec | values)
+                fetched += changed
+            self._db.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                ((*key, rec[kf.ID], json.dumps(rec)) for rec in fetched),
+            )
+
+        deleted: set[int] = set()
+        if not full_sync:
+            if formula_values:
+                live_ids = {rec[kf.ID] for rec in formula_values} # the formula read already listed every row
+            elif self._local_count(key) > self.g.run_sql(f'SELECT COUNT(*) AS n FROM "{table_id}"')[1][0]["n"]:
+                live_ids = {rec[kf.ID] for rec in self.g.run_sql(f'SELECT id FROM "{table_id}"')[1]}
+            else:
+                live_ids = None
+            if live_ids is not None:
+                with self._lock:
+                    deleted = {i for (i,) in self._db.execute("SELECT id FROM records WHERE doc_id = ? AND table_id = ?", key)} - live_ids
+
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM records WHERE doc_id = ? AND table_id = ? AND id = ?", ((*key, i) for i in deleted))
+            self._db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?)", (*key, cols_sig, last_updated, synced_at))
+        log.info(f"synced {table_id}: {len(fetched)} rows fetched{' (full)' if full_sync else ''}, {len(deleted)} deleted")
+        return len(fetched)
+
+    def _local_count(self, key: tuple[str, str]) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM records WHERE doc_id = ? AND table_id = ?", key).fetchone()[0]
+
+    def iter_records(self, table_id: str, col_ids: Iterable[str] | None = None, hidden: bool = False) -> Iterator[dict[str, Any]]:
+        """syncs a table, then yields its records from the local copy, in the same shape as CustomGrister.iter_records"""
+        self.sync(table_id)
+        with self._lock:
+            rows = self._db.execute("SELECT record FROM records WHERE doc_id = ? AND table_id = ? ORDER BY id", (self.doc_id, table_id)).fetchall()
+        converter = self.g.out_converter.get(table_id, {})
+        keep = None if col_ids is None else {kf.ID, *col_ids}
+        for (raw,) in rows:
+            rec: dict[str, Any] = json.loads(raw)
+            if keep is not None:
+                rec = {k: v for k, v in rec.items() if k in keep}
+            elif not hidden:
+                rec = {k: v for k, v in rec.items() if not is_hidden_col(k)}
+            for col_id, convert in converter.items():
+                if col_id in rec:
+                    rec[col_id] = convert(rec[col_id])
+            yield rec
@@ -0,0 +1,65 @@
+# the html parsing half of fetch_site_meta, kept free of grist, windmill and network imports since it's what the parse worker processes load
+import re
+from typing import TypedDict, cast
+from bs4 import BeautifulSoup, NavigableString
+from f.main.boilerplate import dict_filter_falsy, get_timed_logger
+log = get_timed_logger(__name__)
+
+def clean_title(title: str | None, url: str):
+    if not title:
+        return ""
+    if url.startswith("https://github.com"):
+        title = re.sub(r"GitHub - [^/]+/[^:]+: ", "", title)
+    return title
+
+def clean_description(desc: str | None, url: str):
+    if not desc:
+        return ""
+    if re.search(r"development by creating an account on GitHub\.$", desc):
+        return ""
+    return desc
+
+class site_info(TypedDict, total=False):
+    title: str
+    desc: str
+    error: str
+    last_polled: str
+    normalized_url: str
+    etag: str
+    last_modified: str
+    poll_interval: float
+    """days until the site is due for another poll"""
+    error_streak: int
+
+def parse_head(head: bytes, url: str) -> site_info:
+    """extracts the title and description from the start of a page"""
+    out: site_info = {}
+    # some of the sites i tested returned improperly decoded chars by default, for example https://publer.com
+    # therefore, by executive fiat:
+    soup = BeautifulSoup(head.decode('utf-8', errors='replace'), 'html.parser')
+
+    og_title_tag = (
+        soup.find('meta', attrs={'property': 'og:title'}) or
+        soup.find('meta', attrs={'name': 'og:title'})
+    )
+
+    if og_title_tag:
+        assert not isinstance(og_title_tag, NavigableString)
+        out["title"] = clean_title(str(og_title_tag['content']), url)
+    elif title_tag := soup.find('title'):
+        assert not isinstance(title_tag, NavigableString)
+        out["title"] = clean_title(title_tag.string, url)
+
+    og_description = (
+        soup.find("meta", attrs={"property": "og:description"}) or
+        soup.find("meta", attrs={"name": "og:description"}) or
+        soup.find("meta", attrs={"name": "description"})
+    )
+
+    if og_description:
+        assert not isinstance(og_description, NavigableString)
+        out["desc"] = clean_description(og_description.attrs.get("content"), url)
+    elif og_description:
+        log.warning(f"description was not a tag: {og_description}")
+
+    return cast(site_info, dict_filter_falsy(cast(dict, out)))
@@ -0,0 +1,38 @@
+from importlib.util import find_spec
+import os
+import ssl
+from typing import Any
+import certifi
+import httpx
+
+HTTP2 = find_spec("h2") is not None and os.environ.get("HTTP2", "1") != "0"
+"""http/2 needs the optional h2 package (httpx[http2])"""
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+"""default number of connections a client keeps, for callers without their own concurrency setting"""
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30))
+
+ssl_verify: ssl.SSLContext | bool = True if os.environ.get("SSL_CERT_FILE") or os.environ.get("SSL_CERT_DIR") else ssl.create_default_context(cafile=certifi.where())
+"""
+shared by every client, so the ca bundle is only loaded once per process.
+httpx only honours SSL_CERT_FILE/SSL_CERT_DIR (with trust_env) when it builds the context itself, so it's left to do that when either is set
+"""
+
+def pool_limits(concurrency: int = HTTP_POOL_SIZE) -> httpx.Limits:
+    """keep as many idle connections as there can be requests in flight, so steady traffic never reconnects"""
+    return httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+def transport(concurrency: int = HTTP_POOL_SIZE, **kwargs: Any) -> httpx.HTTPTransport:
+    return httpx.HTTPTransport(verify=ssl_verify, http2=HTTP2, limits=pool_limits(concurrency), **kwargs)
+
+def async_transport(concurrency: int = HTTP_POOL_SIZE, **kwargs: Any) -> httpx.AsyncHTTPTransport:
+    return httpx.AsyncHTTPTransport(verify=ssl_verify, http2=HTTP2, limits=pool_limits(concurrency), **kwargs)
+
+def client(concurrency: int = HTTP_POOL_SIZE, **kwargs: Any) -> httpx.Client:
+    """
+    httpx.Client with a pool sized to `concurrency`, http/2 when available and the shared ssl settings. kwargs go to httpx.Client
+    """
+    return httpx.Client(verify=ssl_verify, http2=HTTP2, limits=pool_limits(concurrency), **kwargs)
+
+def async_client(concurrency: int = HTTP_POOL_SIZE, **kwargs: Any) -> httpx.AsyncClient:
+    """async version of client()"""
+    return httpx.AsyncClient(verify=ssl_verify, http2=HTTP2, limits=pool_limits(concurrency), **kwargs)
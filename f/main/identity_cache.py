@@ -0,0 +1,28 @@
+import os
+from f.main.boilerplate import get_timed_logger
+from f.main.sqlite_cache import SqliteCache, cache_path
+log = get_timed_logger(__name__)
+
+IDENTITY_CACHE_PATH = os.environ.get("IDENTITY_CACHE_PATH", cache_path("identity_cache"))
+IDENTITY_CACHE_TTL = float(os.environ.get("IDENTITY_CACHE_TTL", 24 * 60 * 60))
+"""seconds a resolved did/handle is trusted for"""
+IDENTITY_CACHE_NEGATIVE_TTL = float(os.environ.get("IDENTITY_CACHE_NEGATIVE_TTL", 60 * 60))
+"""seconds a failed resolution is remembered for"""
+
+class IdentityCache(SqliteCache):
+    """
+    on-disk cache of identity resolutions.
+    keys are either dids (value is the handle from the did doc) or handles (value is the resolved did). a None value means the key didn't resolve
+    """
+    def __init__(self, path: str = IDENTITY_CACHE_PATH, ttl: float = IDENTITY_CACHE_TTL, negative_ttl: float = IDENTITY_CACHE_NEGATIVE_TTL):
+        super().__init__(path, ttl)
+        self.negative_ttl = negative_ttl
+
+    def max_age(self, value: str | None) -> float:
+        return self.ttl if value is not None else self.negative_ttl
+
+    def get(self, key: str) -> tuple[bool, str | None]:
+        hit, value = super().get(key)
+        if hit:
+            log.debug(f"identity cache hit for {key}: {value}")
+        return hit, value
@@ -0,0 +1,66 @@
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any
+
+ATPT_CACHE_DIR = os.environ.get("ATPT_CACHE_DIR", tempfile.gettempdir())
+"""where the on-disk caches live unless their own path variable is set. the temp dir by default, point it somewhere persistent to keep them across reboots"""
+
+def cache_path(name: str) -> str:
+    return os.path.join(ATPT_CACHE_DIR, f"atpt_{name}.sqlite")
+
+class SqliteCache:
+    """
+    small on-disk key/value cache shared by every script that runs on the same machine. values are stored as json along with when they were set,
+    and entries older than `ttl` seconds read as misses. the file is only opened on first use, so importing a module that has one costs nothing
+    """
+    def __init__(self, path: str, ttl: float = math.inf):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """the connection, opened on first use. callers hold _lock"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, set_at REAL)")
+        return self._conn
+
+    def max_age(self, value: Any) -> float:
+        """seconds an entry holding value stays fresh"""
+        return self.ttl
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        Returns:
+            tuple[bool, Any]: whether there was a fresh entry, and its value
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value, set_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return False, None
+        value = json.loads(row[0])
+        if time.time() - row[1] > self.max_age(value):
+            return False, None
+        return True, value
+
+    def set(self, key: str, value: Any):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    def delete(self, key: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def items(self) -> dict[str, Any]:
+        """all entries set within ttl. max_age isn't applied per value here"""
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM cache WHERE set_at >= ?", (time.time() - self.ttl,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
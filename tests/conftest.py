@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# windmill scripts import their siblings by bare name, so f/main has to be importable both ways
+sys.path[:0] = [root, os.path.join(root, "f", "main")]
+
+# keep the on-disk caches and the crawl journal out of the real temp dir
+cache_dir = tempfile.mkdtemp(prefix="atpt_tests_")
+os.environ.setdefault("ATPT_CACHE_DIR", cache_dir)
+os.environ.setdefault("FETCH_SITE_JOURNAL_DIR", cache_dir)
+# parse on the event loop unless a test is about the worker processes
+os.environ.setdefault("FETCH_SITE_PARSE_WORKERS", "0")
+
+import wmill  # noqa: E402
+wmill.get_variable = lambda *args, **kwargs: "test"
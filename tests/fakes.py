@@ -0,0 +1,33 @@
+import sqlite3
+from f.main.ATPTGrister import CustomGrister
+
+config = {"GRIST_API_KEY": "test", "GRIST_DOC_ID": "doc"}
+
+class SqlGrister(CustomGrister):
+    """CustomGrister whose doc is a local sqlite db. `cols` is the table's schema as (col_id, type, formula) tuples"""
+    def __init__(self, table_id: str, cols: list[tuple[str, str, str]], **kwargs):
+        super().__init__(config, **kwargs)
+        self.table_id = table_id
+        self.cols = cols
+        self.db = sqlite3.connect(":memory:")
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(f'CREATE TABLE "{table_id}" (id INTEGER PRIMARY KEY, {", ".join(f'"{i}"' for i, _, _ in cols)})')
+        self.queries: list[tuple[str, list]] = []
+
+    def insert(self, *rows: dict):
+        for row in rows:
+            keys = ", ".join(f'"{k}"' for k in row)
+            self.db.execute(f'INSERT OR REPLACE INTO "{self.table_id}" ({keys}) VALUES ({", ".join("?" * len(row))})', list(row.values()))
+
+    def list_cols(self, table_id, hidden=False, doc_id="", team_id=""):
+        return 200, [
+            {"id": i, "fields": {"type": type_, "isFormula": bool(formula), "formula": formula}}
+            for i, type_, formula in self.cols if hidden or i != "manualSort"
+        ]
+
+    def run_sql_with_args(self, sql, args, doc_id="", team_id=""):
+        self.queries.append((sql, args))
+        return 200, [dict(r) for r in self.db.execute(sql, args)]
+
+    def run_sql(self, sql, doc_id="", team_id=""):
+        return self.run_sql_with_args(sql, [])
@@ -0,0 +1,197 @@
+from types import SimpleNamespace
+from typing import cast
+from unittest.mock import patch
+import pytest
+from pygrister.api import GristApi
+import f.main.ATPTGrister as atpt
+from f.main.ATPTGrister import CustomGrister, kf
+from f.main.identity_cache import IdentityCache
+from fakes import SqlGrister, config
+
+def test_apicall_error_reports_its_own_response():
+    g = CustomGrister(config)
+    # another thread's call already left its details on the shared client
+    g.resp_reason, g.resp_content = "OK", "someone else's body"
+    with patch.object(GristApi, "apicall", return_value=(500, {"error": "boom"})):
+        with pytest.raises(IOError) as e:
+            g.apicall("https://grist.test/api/docs/doc/tables")
+    assert e.value.errno == 500
+    assert "boom" in e.value.strerror
+    assert "someone else" not in e.value.strerror
+
+def test_apicall_passes_success_through():
+    g = CustomGrister(config)
+    with patch.object(GristApi, "apicall", return_value=(200, {"tables": []})):
+        assert g.apicall("https://grist.test/api/docs/doc/tables") == (200, {"tables": []})
+
+def make_sites(n: int) -> SqlGrister:
+    g = SqlGrister("Sites", [("url", "Text", ""), ("tags", "ChoiceList", ""), ("live", "Bool", ""), ("manualSort", "ManualSortPos", "")])
+    g.insert(*({"id": i, "url": f"https://{i}.test", "tags": '["a"]' if i % 2 else None, "live": i % 2, "manualSort": i} for i in range(1, n + 1)))
+    return g
+
+def test_iter_records_pages_by_id():
+    g = make_sites(7)
+    recs = list(g.iter_records("Sites", page_size=3))
+    assert [r["id"] for r in recs] == list(range(1, 8))
+    # keyset paging: each page starts after the last id of the one before
+    assert [args for _, args in g.queries] == [[0], [3], [6]]
+    assert all("ORDER BY id LIMIT 3" in sql for sql, _ in g.queries)
+
+def test_iter_records_stops_after_full_last_page():
+    g = make_sites(6)
+    assert len(list(g.iter_records("Sites", page_size=3))) == 6
+    assert len(g.queries) == 3 # the empty page is what tells it the table ended
+
+def test_iter_records_shapes_like_list_records():
+    g = make_sites(2)
+    first, second = g.iter_records("Sites")
+    assert first == {"id": 1, "url": "https://1.test", "tags": ["L", "a"], "live": True}
+    assert second["tags"] is None and second["live"] is False
+    assert "manualSort" in next(g.iter_records("Sites", hidden=True))
+
+def test_iter_records_keeps_caller_filter():
+    g = make_sites(10)
+    recs = list(g.iter_records("Sites", ["url"], where="live = ?", args=[1], page_size=2))
+    assert [r["id"] for r in recs] == [1, 3, 5, 7, 9]
+    assert g.queries[1] == ('SELECT "id", "url" FROM "Sites" WHERE (live = ?) AND id > ? ORDER BY id LIMIT 2', [1, 3])
+
+def upsert_grister(responses: list) -> tuple[CustomGrister, list[list]]:
+    """CustomGrister whose PUTs answer with `responses` in order: an exception to raise or anything else to succeed"""
+    g = CustomGrister(config)
+    sent = []
+    def apicall(url, method="GET", headers=None, params=None, json=None, filename=""):
+        sent.append([rec["require"]["n"] for rec in json["records"]])
+        if isinstance(resp := responses.pop(0), Exception):
+            raise resp
+        return 200, None
+    g.apicall = apicall
+    return g, sent
+
+records = [{"require": {"n": i}, "fields": {}} for i in range(5)]
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr("f.main.ATPTGrister.time.sleep", lambda s: None)
+
+def test_upsert_sends_chunks_in_order(monkeypatch):
+    monkeypatch.setattr("f.main.ATPTGrister.UPSERT_MAX_ROWS", 2)
+    g, sent = upsert_grister([None] * 3)
+    assert g.add_update_records("T", records) == (200, None)
+    assert sent == [[0, 1], [2, 3], [4]]
+
+def test_upsert_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr("f.main.ATPTGrister.UPSERT_MAX_ROWS", 2)
+    g, sent = upsert_grister([None, IOError(503, "busy"), None, None])
+    g.add_update_records("T", records)
+    assert sent == [[0, 1], [2, 3], [2, 3], [4]]
+
+def test_upsert_failure_reports_applied_chunks(monkeypatch):
+    monkeypatch.setattr("f.main.ATPTGrister.UPSERT_MAX_ROWS", 2)
+    g, sent = upsert_grister([None, IOError(400, "bad row"), None])
+    with pytest.raises(IOError) as e:
+        g.add_update_records("T", records)
+    assert sent == [[0, 1], [2, 3]] # nothing after the failed chunk is sent
+    assert e.value.errno == 400
+    assert "chunk 2/3" in e.value.strerror and "2/5 rows" in e.value.strerror
+
+def test_upsert_respects_safemode():
+    from pygrister.api import GristApiInSafeMode
+    g, sent = upsert_grister([None])
+    g.safemode = True
+    with pytest.raises(GristApiInSafeMode):
+        g.add_update_records("T", records)
+    assert not sent
+
+@pytest.mark.parametrize("method, args", [
+    ("add_tables", ([{"id": "Sites", "columns": []}],)),
+    ("update_tables", ([{"id": "Sites", "fields": {}}],)),
+    ("add_cols", ("Sites", [])),
+    ("update_cols", ("Sites", [])),
+    ("delete_column", ("Sites", "url")),
+])
+def test_schema_changes_drop_cached_schema(method, args):
+    g = CustomGrister(config)
+    calls = []
+    def list_call(*a, **kw):
+        calls.append(a)
+        return 200, []
+    with patch.object(GristApi, "list_tables", side_effect=list_call), patch.object(GristApi, "list_cols", side_effect=list_call):
+        g.list_tables(), g.list_cols("Sites"), g.list_tables(), g.list_cols("Sites")
+        assert len(calls) == 2
+        with patch.object(GristApi, method, return_value=(200, None)):
+            getattr(g, method)(*args)
+        g.list_tables(), g.list_cols("Sites")
+    assert len(calls) == (4 if method.endswith("tables") else 3)
+
+def test_select_records_in_batches_and_dedupes():
+    g = make_sites(7)
+    recs = g.select_records_in("Sites", ["url"], [5, 1, 5, 7, 2, 99], batch_size=2)
+    assert sorted(r["id"] for r in recs) == [1, 2, 5, 7]
+    assert [args for _, args in g.queries] == [[5, 1], [7, 2], [99]]
+
+def test_select_records_in_by_other_column():
+    g = make_sites(3)
+    recs = g.select_records_in("Sites", ["url"], ["https://3.test"], match_col="url")
+    assert [r["id"] for r in recs] == [3]
+
+@pytest.fixture
+def identities(monkeypatch, tmp_path):
+    """a fresh identity cache, and a sync resolver that knows one account and counts its lookups"""
+    monkeypatch.setattr(atpt, "id_cache", IdentityCache(str(tmp_path / "ids.sqlite")))
+    lookups = []
+    def resolve_did(did):
+        lookups.append(did)
+        return SimpleNamespace(get_handle=lambda: "alice.test") if did == "did:plc:alice" else None
+    def resolve_handle(handle):
+        lookups.append(handle)
+        return "did:plc:alice" if handle == "alice.test" else None
+    monkeypatch.setattr(atpt, "resolver", SimpleNamespace(did=SimpleNamespace(resolve=resolve_did), handle=SimpleNamespace(resolve=resolve_handle)))
+    return lookups
+
+def test_identity_lookups_are_cached(identities):
+    g = CustomGrister(config)
+    assert g.get_handle("did:plc:alice") == "alice.test"
+    assert g._fetch_did("alice.test") == "did:plc:alice"
+    assert g._fetch_did("nobody.test") is None
+    fresh = CustomGrister(config) # a later run on the same machine
+    assert fresh.get_handle("did:plc:alice") == "alice.test"
+    assert fresh._fetch_did("alice.test") == "did:plc:alice"
+    assert fresh._fetch_did("nobody.test") is None # the failure is remembered too
+    assert identities == ["did:plc:alice", "alice.test", "nobody.test"]
+
+class FakeAsyncResolver:
+    """AsyncIdResolver stand-in: knows alice, fails on did:plc:broken, and records its lookups"""
+    lookups: list[str] = []
+
+    def __init__(self):
+        async def resolve_did(did):
+            FakeAsyncResolver.lookups.append(did)
+            if did == "did:plc:broken":
+                raise ConnectionError("plc directory down")
+            return SimpleNamespace(get_handle=lambda: "alice.test") if did == "did:plc:alice" else None
+        async def resolve_handle(handle):
+            FakeAsyncResolver.lookups.append(handle)
+            return "did:plc:alice" if handle == "alice.test" else None
+        self.did = SimpleNamespace(resolve=resolve_did)
+        self.handle = SimpleNamespace(resolve=resolve_handle)
+
+def test_resolve_identities(identities, monkeypatch):
+    import asyncio
+    FakeAsyncResolver.lookups = []
+    monkeypatch.setattr(atpt, "AsyncIdResolver", FakeAsyncResolver)
+    g = CustomGrister(config)
+    g.authors_lookup[cast(kf, "did:plc:known")] = {"handle": "known.test"}
+    inputs = ["https://bsky.app/profile/alice.test", "alice.test", "did:plc:alice", "did:plc:known", "did:plc:broken", "nobody.test", "not a handle"]
+    assert asyncio.run(g.resolve_identities(inputs)) == {
+        "https://bsky.app/profile/alice.test": "did:plc:alice",
+        "alice.test": "did:plc:alice",
+        "did:plc:alice": "alice.test",
+        "did:plc:known": "known.test",
+        "did:plc:broken": None,
+        "nobody.test": None,
+    }
+    assert sorted(FakeAsyncResolver.lookups) == ["alice.test", "did:plc:alice", "did:plc:broken", "nobody.test"] # each once, known authors skipped
+    # the results are in the cache now, apart from the error which is tried again next time
+    assert g._fetch_did("alice.test") == "did:plc:alice" and g.get_handle("did:plc:alice") == "alice.test"
+    assert identities == []
+    assert atpt.id_cache.get("did:plc:broken") == (False, None)
@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from fakes import SqlGrister
+from f.main.ATPTGrister import kf, names_col, t
+
+Collector = pytest.importorskip("f.main.Collector")
+
+def test_load_site_fields_projects_this_sources_rows():
+    g = SqlGrister(t.SITES, [
+        (kf.NORMAL_URL, "Text", ""), (names_col, "Text", ""), ("src_title", "Text", ""), ("src_rating", "Numeric", ""), ("other_title", "Text", ""),
+    ])
+    g.insert(*(
+        {kf.ID: i, kf.NORMAL_URL: f"https://{i}.test", names_col: "{}", "src_title": f"t{i}", "src_rating": i, "other_title": "x"}
+        for i in range(1, 5)
+    ))
+    sites = {f"https://{i}.test": {kf.ID: i, t.SOURCES: sources} for i, sources in [(1, ["L", 7]), (2, ["L", 3]), (3, None), (4, ["L", 3, 7])]}
+    collector = SimpleNamespace(g=g, sites=sites, new_sites={"https://3.test": {}}, _source_id=7, _fields=["src_title", "src_rating"])
+    Collector.Collector._load_site_fields(collector)
+
+    [(sql, args)] = g.queries
+    assert sql.startswith(f'SELECT "id", "{kf.NORMAL_URL}", "{names_col}", "src_title", "src_rating" FROM "{t.SITES}"') and "other_title" not in sql
+    assert sorted(args) == [1, 3, 4] # in this source, or seen in this run
+    assert sites["https://1.test"]["src_title"] == "t1" and sites["https://1.test"][t.SOURCES] == ["L", 7]
+    assert "src_title" not in sites["https://2.test"]
+
+def test_fetch_sites_meta_gathers_and_shuts_down_the_pool(monkeypatch):
+    fetched, shutdowns = [], []
+    async def check_and_fetch(rec, threshold):
+        fetched.append((rec["url"], threshold))
+        await asyncio.sleep(0)
+        return {"atpt": {"title": rec["url"]}}
+    monkeypatch.setattr(Collector, "check_and_fetch", check_and_fetch)
+    monkeypatch.setattr(Collector, "shutdown_parse_pool", lambda: shutdowns.append(True))
+    collector = SimpleNamespace(
+        sites={"https://a.test": {"url": "https://a.test", names_col: {"atpt": {}}}},
+        new_sites={"https://a.test": {names_col: {"src": {"title": "mine"}}}, "https://b.test": {"url": "https://b.test"}},
+    )
+    asyncio.run(Collector.Collector._fetch_sites_meta(collector, 14))
+    assert sorted(fetched) == [("https://a.test", 14), ("https://b.test", 14)] # stored row when there is one
+    assert collector.new_sites["https://a.test"][names_col] == {"atpt": {"title": "https://a.test"}, "src": {"title": "mine"}}
+    assert collector.new_sites["https://b.test"][names_col] == {"atpt": {"title": "https://b.test"}}
+    assert shutdowns == [True]
+
+def test_fetch_sites_meta_shuts_down_the_pool_when_a_fetch_raises(monkeypatch):
+    shutdowns = []
+    async def check_and_fetch(rec, threshold):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(Collector, "check_and_fetch", check_and_fetch)
+    monkeypatch.setattr(Collector, "shutdown_parse_pool", lambda: shutdowns.append(True))
+    collector = SimpleNamespace(sites={}, new_sites={"https://a.test": {"url": "https://a.test"}})
+    with pytest.raises(RuntimeError):
+        asyncio.run(Collector.Collector._fetch_sites_meta(collector, 14))
+    assert shutdowns == [True]
@@ -0,0 +1,30 @@
+import asyncio
+from f.main.boilerplate import LoopLocal, run_sync
+
+async def answer():
+    await asyncio.sleep(0)
+    return 42
+
+def test_run_sync_without_loop():
+    assert run_sync(answer()) == 42
+
+def test_run_sync_inside_running_loop():
+    # e.g. a Collector built from an async windmill script
+    async def caller():
+        return run_sync(answer())
+    assert asyncio.run(caller()) == 42
+
+def test_loop_local_makes_one_per_loop():
+    made = []
+    sem = LoopLocal(lambda: made.append(asyncio.Semaphore(1)) or made[-1])
+    async def use():
+        async with sem.get():
+            await asyncio.sleep(0)
+        return sem.get()
+    first = asyncio.run(use())
+    assert asyncio.run(use()) is not first # a semaphore from a closed loop isn't reused
+    assert run_sync(use()) is not first
+    assert len(made) == 3
+    async def twice():
+        return sem.get() is sem.get()
+    assert asyncio.run(twice())
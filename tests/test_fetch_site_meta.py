@@ -0,0 +1,296 @@
+import asyncio
+from datetime import UTC, datetime, timedelta
+from email.utils import format_datetime
+import httpx
+import pytest
+from f.main.ATPTGrister import gf, kf, names_col, normalize_url, site_source_name
+from f.main.boilerplate import LoopLocal
+import f.main.fetch_site_meta as fsm
+
+def streamed(*chunks: bytes) -> tuple[httpx.Response, list[bytes]]:
+    """a streamed response over chunks, plus the list of chunks it has handed out so far"""
+    read = []
+    async def body():
+        for chunk in chunks:
+            read.append(chunk)
+            yield chunk
+    return httpx.Response(200, content=body(), request=httpx.Request("GET", "https://site.test")), read
+
+def test_read_head_stops_at_end_of_head():
+    response, read = streamed(b"<html><head><title>t</title>", b"</head><body>", b"never read")
+    assert asyncio.run(fsm.read_head(response)) == b"<html><head><title>t</title>"
+    assert len(read) == 2
+
+def test_read_head_finds_tag_split_across_chunks():
+    response, _ = streamed(b"<head><title>t</title></he", b"ad>rest")
+    assert asyncio.run(fsm.read_head(response)) == b"<head><title>t</title>"
+
+def test_read_head_stops_at_body_without_closing_head():
+    response, _ = streamed(b"<head><title>t</title><BODY class=x>")
+    assert asyncio.run(fsm.read_head(response)) == b"<head><title>t</title>"
+
+def test_read_head_caps_size(monkeypatch):
+    monkeypatch.setattr(fsm, "FETCH_SITE_MAX_HEAD_BYTES", 10)
+    response, read = streamed(b"<head>" + b"x" * 8, b"y" * 8, b"z" * 8)
+    assert asyncio.run(fsm.read_head(response)) == b"<head>xxxx"
+    assert len(read) == 1
+
+def test_read_head_returns_short_documents_whole():
+    response, _ = streamed(b"<title>t</title>")
+    assert asyncio.run(fsm.read_head(response)) == b"<title>t</title>"
+
+class SitesTable:
+    """stand-in for the grist client _main uses, keeping the Sites names column in memory"""
+    _config = {"GRIST_DOC_ID": "doc"}
+
+    def __init__(self, sites: dict[str, dict]):
+        self.names = {url: {site_source_name: site} for url, site in sites.items()}
+
+    def read_table(self, table_id, col_ids=None):
+        return [{kf.NORMAL_URL: url, "url": f"https://{url}", names_col: names} for url, names in self.names.items()]
+
+    def add_update_records(self, table_id, records):
+        for rec in records:
+            self.names[rec[gf.KEY][kf.NORMAL_URL]] = rec[gf.FIELDS][names_col]
+
+class Site:
+    """mock http server for one page, answering conditional requests with a 304 when its etag matches"""
+    def __init__(self, title: str = "same", etag: str = '"v1"'):
+        self.title, self.etag = title, etag
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.headers.get("if-none-match") == self.etag:
+            return httpx.Response(304)
+        return httpx.Response(200, html=f"<head><title>{self.title}</title></head>", headers={"etag": self.etag})
+
+def days_ago(days: float) -> str:
+    return (datetime.now(UTC) - timedelta(days=days)).isoformat(timespec="minutes")
+
+@pytest.fixture
+def run(monkeypatch, tmp_path):
+    """patches _main's grist client and http client, returns a function that does one run and gives its output"""
+    def setup(table: SitesTable, site: Site):
+        monkeypatch.setattr(fsm, "ATPTGrister", lambda *args: table)
+        monkeypatch.setattr(fsm, "c", LoopLocal(lambda: httpx.AsyncClient(transport=httpx.MockTransport(site))))
+        monkeypatch.setattr(fsm, "FETCH_SITE_JOURNAL_DIR", str(tmp_path))
+        return lambda: asyncio.run(fsm._main())
+    return setup
+
+def test_not_modified_poll_is_persisted(run):
+    polled = days_ago(fsm.SITE_POLL_MAX_DAYS + 1)
+    table = SitesTable({"a.test": {"title": "same", "etag": '"v1"', "last_polled": polled, "poll_interval": fsm.SITE_POLL_MAX_DAYS}})
+    site = Site()
+    once = run(table, site)
+    assert once() is None # nothing changed, so nothing to report
+    assert site.requests[0].headers["if-none-match"] == '"v1"'
+    saved = table.names["a.test"][site_source_name]
+    assert saved["last_polled"] != polled and saved["title"] == "same"
+    once()
+    assert len(site.requests) == 1 # not due again yet
+
+def test_changed_validator_alone_is_saved_but_not_reported(run):
+    table = SitesTable({"a.test": {"title": "same", "etag": '"v1"', "last_polled": days_ago(fsm.SITE_POLL_MAX_DAYS + 1), "poll_interval": fsm.SITE_POLL_MAX_DAYS}})
+    site = Site(etag='"v2"') # e.g. a server that makes a new etag on every response
+    assert run(table, site)() is None
+    assert table.names["a.test"][site_source_name]["etag"] == '"v2"'
+
+def test_changed_title_is_reported(run):
+    table = SitesTable({"a.test": {"title": "old", "last_polled": days_ago(3), "poll_interval": 2}})
+    out = run(table, Site(title="new"))()
+    assert [(r[kf.NORMAL_URL], r["title"]) for r in out["table-row-object"]] == [("a.test", "new")]
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("120", 120),
+    (" 5 ", 5),
+    ("0", 0),
+    ("soon", None),
+    (format_datetime(datetime.now(UTC) - timedelta(hours=1), usegmt=True), 0), # clock skew or a stale cached response
+])
+def test_parse_retry_after(value, expected):
+    assert fsm.parse_retry_after(value) == expected
+
+def test_parse_retry_after_future_date():
+    delay = fsm.parse_retry_after(format_datetime(datetime.now(UTC) + timedelta(seconds=90), usegmt=True))
+    assert delay is not None and 80 < delay <= 90
+
+@pytest.mark.parametrize("retry_after, expected", [("0", 0), ("30", 30), (None, 4), ("9999", fsm.FETCH_SITE_MAX_BACKOFF)])
+def test_back_off_delay(retry_after, expected, monkeypatch):
+    monkeypatch.setattr(fsm.time, "monotonic", lambda: 1000.0)
+    scheduler = fsm.HostScheduler(4, 2)
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    scheduler.back_off("a.test", httpx.Response(429, headers=headers), attempt=2)
+    assert scheduler.paused_until["a.test"] == 1000 + expected
+
+def test_journal_resumes_after_a_failed_run(tmp_path):
+    with pytest.raises(KeyboardInterrupt):
+        with fsm.CrawlJournal("doc", str(tmp_path)) as journal:
+            journal.record("a.test", "changed", {"site": {"title": "a"}})
+            raise KeyboardInterrupt
+    assert journal._file.closed
+    with fsm.CrawlJournal("doc", str(tmp_path)) as journal:
+        assert journal.entries["a.test"]["names"] == {"site": {"title": "a"}}
+    assert not list(tmp_path.iterdir()) # a finished run cleans up
+
+def test_journal_is_per_doc_and_exclusive(tmp_path):
+    with fsm.CrawlJournal("doc/1", str(tmp_path)) as one, fsm.CrawlJournal("doc2", str(tmp_path)) as two:
+        assert one.path != two.path
+        with pytest.raises(RuntimeError):
+            fsm.CrawlJournal("doc/1", str(tmp_path))
+
+def test_stale_journal_starts_over(tmp_path, monkeypatch):
+    with pytest.raises(KeyboardInterrupt):
+        with fsm.CrawlJournal("doc", str(tmp_path)) as journal:
+            journal.record("a.test", "changed", {})
+            raise KeyboardInterrupt
+    monkeypatch.setattr(fsm, "FETCH_SITE_JOURNAL_MAX_AGE", -1)
+    with fsm.CrawlJournal("doc", str(tmp_path)) as journal:
+        assert not journal.entries
+        journal.record("b.test", "unchanged")
+        with open(journal.path) as f:
+            assert "a.test" not in f.read()
+
+@pytest.mark.parametrize("prev, new, interval", [
+    ({}, {"title": "a"}, fsm.SITE_POLL_MIN_DAYS), # first poll: the title "changed" from nothing
+    ({"title": "a", "poll_interval": 4}, {"title": "a"}, 6),
+    ({"title": "a", "poll_interval": 4}, {"title": "b"}, 2),
+    ({"title": "a", "desc": "x", "poll_interval": 4}, {"title": "a"}, 2),
+    ({"title": "a", "poll_interval": fsm.SITE_POLL_MAX_DAYS}, {"title": "a"}, fsm.SITE_POLL_MAX_DAYS),
+    ({"title": "a", "poll_interval": fsm.SITE_POLL_MIN_DAYS}, {"title": "b"}, fsm.SITE_POLL_MIN_DAYS),
+    ({"error": "500", "error_streak": 3, "poll_interval": 8}, {"title": "a"}, fsm.SITE_POLL_MIN_DAYS),
+])
+def test_schedule_next_poll(prev, new, interval):
+    fsm.schedule_next_poll(prev, new)
+    assert new["poll_interval"] == interval
+    assert "error_streak" not in new
+
+def test_schedule_next_poll_backs_off_errors():
+    prev: dict = {"title": "a", "poll_interval": 30}
+    intervals = []
+    for _ in range(6):
+        new: dict = {"error": "503 Service Unavailable"}
+        fsm.schedule_next_poll(prev, new)
+        intervals.append(new["poll_interval"])
+        prev = new
+    assert intervals == [2, 4, 8, fsm.SITE_POLL_ERROR_MAX_DAYS, fsm.SITE_POLL_ERROR_MAX_DAYS, fsm.SITE_POLL_ERROR_MAX_DAYS]
+    assert prev["error_streak"] == 6
+
+def test_capped_unchanged_site_is_not_refetched(run):
+    # no validators, so every poll is a full 200 with the same metadata
+    table = SitesTable({"a.test": {"title": "same", "last_polled": days_ago(fsm.SITE_POLL_MAX_DAYS + 1), "poll_interval": fsm.SITE_POLL_MAX_DAYS}})
+    site = Site(etag="")
+    once = run(table, site)
+    assert once() is None
+    assert table.names["a.test"][site_source_name]["poll_interval"] == fsm.SITE_POLL_MAX_DAYS
+    once()
+    assert len(site.requests) == 1
+
+def test_growing_interval_alone_is_not_reported(run):
+    table = SitesTable({"a.test": {"title": "same", "last_polled": days_ago(3), "poll_interval": 2}})
+    assert run(table, Site(etag=""))() is None
+    assert table.names["a.test"][site_source_name]["poll_interval"] == 3
+
+@pytest.mark.parametrize("headers", [
+    {"content-type": "text/html; charset=utf-8"},
+    {"content-type": "APPLICATION/XHTML+XML"},
+    {}, # servers that don't say get the benefit of the doubt
+    {"content-type": "text/html", "content-length": str(fsm.FETCH_SITE_MAX_CONTENT_LENGTH)},
+])
+def test_check_response_accepts(headers):
+    fsm.check_response(httpx.Response(200, headers=headers))
+
+@pytest.mark.parametrize("headers, error", [
+    ({"content-type": "application/pdf"}, fsm.UnsupportedContentType),
+    ({"content-type": "image/png; foo=bar"}, fsm.UnsupportedContentType),
+    ({"content-type": "text/html", "content-length": str(fsm.FETCH_SITE_MAX_CONTENT_LENGTH + 1)}, fsm.ResponseTooLarge),
+])
+def test_check_response_rejects(headers, error):
+    with pytest.raises(error):
+        fsm.check_response(httpx.Response(200, headers=headers))
+
+def test_rejected_response_is_an_error_without_reading_body(monkeypatch):
+    read = []
+    async def body():
+        read.append(True)
+        yield b"%PDF"
+    monkeypatch.setattr(fsm, "c", LoopLocal(lambda: httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, headers={"content-type": "application/pdf"}, content=body())
+    ))))
+    out = asyncio.run(fsm.fetch_site_meta("https://site.test/doc.pdf"))
+    assert out == {"error": "UnsupportedContentType: application/pdf"}
+    assert not read
+
+def test_parse_pool_runs_in_processes_and_shuts_down(monkeypatch):
+    monkeypatch.setattr(fsm, "FETCH_SITE_PARSE_WORKERS", 2)
+    try:
+        out = asyncio.run(fsm.parse_in_pool(b"<title>t</title>", "https://site.test"))
+        assert out == {"title": "t"}
+        assert isinstance(fsm._parse_pool, fsm.ProcessPoolExecutor)
+    finally:
+        fsm.shutdown_parse_pool()
+    assert fsm._parse_pool is None
+
+class RecordingSites(SitesTable):
+    def __init__(self):
+        super().__init__({})
+        self.calls: list[int] = []
+
+    def add_update_records(self, table_id, records):
+        self.calls.append(len(records))
+        super().add_update_records(table_id, records)
+
+def queued_site(i: int) -> dict:
+    return {gf.KEY: {kf.NORMAL_URL: f"s{i}.test"}, gf.FIELDS: {names_col: {site_source_name: {"title": f"s{i}"}}}}
+
+def test_write_back_flushes_every_n_rows(monkeypatch):
+    monkeypatch.setattr(fsm, "FETCH_SITE_FLUSH_ROWS", 2)
+    monkeypatch.setattr(fsm, "FETCH_SITE_FLUSH_SECONDS", 60)
+    table = RecordingSites()
+    async def go():
+        queue = asyncio.Queue()
+        for i in range(5):
+            await queue.put(queued_site(i))
+        await queue.put(None)
+        return await fsm.write_back(table, queue, {"s1.test", "s4.test"})
+    written = asyncio.run(go())
+    assert table.calls == [2, 2, 1] # the leftover row goes out when the queue ends
+    assert len(table.names) == 5
+    assert written == [{"title": f"s{i}", kf.NORMAL_URL: f"s{i}.test"} for i in (1, 4)] # only the reported ones are kept
+
+def test_write_back_flushes_on_a_timer(monkeypatch):
+    monkeypatch.setattr(fsm, "FETCH_SITE_FLUSH_ROWS", 100)
+    monkeypatch.setattr(fsm, "FETCH_SITE_FLUSH_SECONDS", 0.05)
+    table = RecordingSites()
+    async def go():
+        queue = asyncio.Queue()
+        writer = asyncio.create_task(fsm.write_back(table, queue, set()))
+        await queue.put(queued_site(0))
+        await asyncio.sleep(0.2)
+        flushed_before_end = list(table.calls)
+        await queue.put(None)
+        await writer
+        return flushed_before_end
+    assert asyncio.run(go()) == [1] # written while the run was still going
+    assert table.calls == [1]
+
+class RecordingRedirects:
+    def __init__(self):
+        self.sets: list[tuple[str, str]] = []
+
+    def set(self, url, canonical):
+        self.sets.append((url, canonical))
+
+def test_only_redirects_are_recorded(monkeypatch):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/old":
+            return httpx.Response(301, headers={"location": "https://site.test/new"})
+        return httpx.Response(200, html="<head><title>t</title></head>")
+    monkeypatch.setattr(fsm, "c", LoopLocal(lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler), follow_redirects=True)))
+    monkeypatch.setattr(fsm, "canonical_urls", redirects := RecordingRedirects())
+    async def go():
+        return await fsm.fetch_site_meta("https://site.test/old"), await fsm.fetch_site_meta("https://site.test/new")
+    assert asyncio.run(go()) == ({"title": "t"}, {"title": "t"})
+    assert redirects.sets == [(normalize_url("https://site.test/old"), normalize_url("https://site.test/new"))]
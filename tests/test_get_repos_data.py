@@ -0,0 +1,95 @@
+import asyncio
+import zlib
+import httpx
+import pytest
+from f.main.ATPTGrister import mf
+
+pytest.importorskip("at_url_converter")
+import get_repos_data as grd  # noqa: E402
+
+def contributors_response(status: int = 200, **kwargs) -> httpx.Response:
+    return httpx.Response(status, request=httpx.Request("GET", "https://api.github.com/repos/o/r/contributors"), **kwargs)
+
+@pytest.fixture
+def github(monkeypatch):
+    """makes gh_get_conditional derive its value from the given response, or raise the given exception"""
+    def answer(response: httpx.Response | Exception):
+        async def get(url, derive):
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            return derive(response)
+        monkeypatch.setattr(grd, "gh_get_conditional", get)
+    return answer
+
+def test_counts_from_last_page_link(github):
+    github(contributors_response(json=[{}], headers={"link": '<https://api.github.com/repositories/1/contributors?per_page=1&page=42>; rel="last"'}))
+    assert asyncio.run(grd.count_contributors("o", "r")) == 42
+
+def test_single_contributor(github):
+    github(contributors_response(json=[{}]))
+    assert asyncio.run(grd.count_contributors("o", "r")) == 1
+
+@pytest.mark.parametrize("answer", [
+    contributors_response(204), # empty repo
+    contributors_response(json=[]),
+    contributors_response(404),
+    contributors_response(json=[{}], headers={"link": '<https://api.github.com/x?per_page=1>; rel="last"'}),
+    httpx.ConnectError("reset"),
+])
+def test_failed_count_is_none(github, answer):
+    github(answer)
+    assert asyncio.run(grd.count_contributors("o", "r")) is None
+
+url = "https://github.com/o/r"
+polled = 1_700_000_000
+committed = "2023-11-01T00:00:00+00:00"
+
+@pytest.fixture
+def not_refresh_day(monkeypatch):
+    """moves the poll to a day that isn't url's periodic full refresh"""
+    day = zlib.crc32(url.encode()) % grd.GITHUB_FULL_REFRESH_DAYS + 1
+    monkeypatch.setattr(grd, "poll_timestamp", day * 24 * 60 * 60)
+
+def state(pushed_at: str = "2023-11-01T00:00:00+00:00", committed_date: str = committed) -> dict:
+    return {"pushedAt": pushed_at, "defaultBranchRef": {"target": {"oid": "abc", "committedDate": committed_date}}}
+
+def old(**fields) -> dict:
+    return {mf.POLLED: polled, "updatedAt": grd.make_timestamp(committed)} | fields
+
+def test_unchanged_repo(not_refresh_day):
+    assert not grd.repo_changed(url, old(), state())
+
+@pytest.mark.parametrize("old_rec, new_state", [
+    ({}, state()), # never polled
+    (old(**{mf.STATUS: "not found"}), state()),
+    (old(), state(pushed_at="2023-11-20T00:00:00+00:00")), # pushed since the last poll, to any branch
+    (old(), state(committed_date="2023-11-02T00:00:00+00:00")), # default branch moved
+])
+def test_changed_repo(not_refresh_day, old_rec, new_state):
+    assert grd.repo_changed(url, old_rec, new_state)
+
+def test_periodic_full_refresh(monkeypatch):
+    day = zlib.crc32(url.encode()) % grd.GITHUB_FULL_REFRESH_DAYS
+    monkeypatch.setattr(grd, "poll_timestamp", day * 24 * 60 * 60)
+    assert grd.repo_changed(url, old(), state())
+
+def test_query_repos_releases_points_and_cancels_on_error(monkeypatch):
+    monkeypatch.setattr(grd, "GITHUB_GRAPHQL_CONCURRENCY", 3)
+    budget = type(grd.gh_budget)()
+    monkeypatch.setattr(grd, "gh_budget", budget)
+    cancelled = []
+    async def gh_graphql(query: str):
+        if "r0:" in query:
+            raise RuntimeError("unexpected")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(query)
+            raise
+    monkeypatch.setattr(grd, "gh_graphql", gh_graphql)
+    repos = [("o", f"r{i}") for i in range(3)]
+    with pytest.raises(RuntimeError):
+        asyncio.run(asyncio.wait_for(grd.query_repos(repos, "", "repoState", batch_size=1), 5))
+    assert len(cancelled) == 2
+    assert budget.in_flight == 0
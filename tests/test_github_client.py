@@ -0,0 +1,206 @@
+import asyncio
+import time
+import httpx
+import pytest
+import f.main.github_client as gc
+
+class Recorder(httpx.AsyncBaseTransport):
+    """answers everything with an empty 200 and notes when each request went out"""
+    def __init__(self):
+        self.sent: list[tuple[str, float]] = []
+
+    async def handle_async_request(self, request):
+        self.sent.append((request.url.path, time.monotonic()))
+        return httpx.Response(200, headers={"x-ratelimit-remaining": "100"})
+
+def paced_transport(rest: float, graphql: float) -> tuple[gc.AsyncGitHubRateLimitRetryTransport, Recorder]:
+    transport = gc.AsyncGitHubRateLimitRetryTransport(rest, graphql)
+    transport.main_transport = recorder = Recorder()
+    return transport, recorder
+
+def test_rest_and_graphql_are_paced_separately():
+    transport, recorder = paced_transport(rest=0, graphql=0.2)
+    async def run():
+        async with httpx.AsyncClient(transport=transport, base_url="https://api.github.com") as client:
+            start = time.monotonic()
+            await asyncio.gather(
+                client.post("/graphql"), client.post("/graphql"),
+                *(client.get(f"/repos/o/r{i}") for i in range(5)),
+            )
+            return start
+    start = asyncio.run(run())
+    rest = [t - start for path, t in recorder.sent if path != "/graphql"]
+    graphql = sorted(t - start for path, t in recorder.sent if path == "/graphql")
+    assert max(rest) < 0.1 # not stuck behind the graphql cooldown
+    assert graphql[1] - graphql[0] >= 0.19
+
+class RateLimitedOnce(Recorder):
+    """the first request hits the secondary rate limit, everything after goes through"""
+    async def handle_async_request(self, request):
+        await super().handle_async_request(request)
+        if len(self.sent) == 1:
+            return httpx.Response(403, headers={"x-ratelimit-remaining": "100", "retry-after": "1"}, json={"message": "secondary rate limit"})
+        return httpx.Response(200, headers={"x-ratelimit-remaining": "100"})
+
+def test_rate_limit_wait():
+    assert gc.rate_limit_wait(httpx.Response(200, headers={"x-ratelimit-remaining": "10"})) == 0
+    assert gc.rate_limit_wait(httpx.Response(403, headers={"x-ratelimit-remaining": "10", "retry-after": "30"}, json={})) == 31
+    reset = int(time.time()) + 60
+    assert 59 <= gc.rate_limit_wait(httpx.Response(403, headers={"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(reset)}, json={})) <= 62
+    # remaining 0 with a reset already past isn't a wait
+    assert gc.rate_limit_wait(httpx.Response(200, headers={"x-ratelimit-remaining": "0", "x-ratelimit-reset": "1"})) == 0
+
+def test_rate_limit_holds_back_the_whole_lane(monkeypatch):
+    transport = gc.AsyncGitHubRateLimitRetryTransport(0, 0)
+    transport.main_transport = recorder = RateLimitedOnce()
+    sleeps: list[float] = []
+    real_sleep = asyncio.sleep
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        await real_sleep(0)
+    monkeypatch.setattr(gc.asyncio, "sleep", fake_sleep)
+    async def run():
+        async with httpx.AsyncClient(transport=transport, base_url="https://api.github.com") as client:
+            first = await client.get("/repos/o/r")
+            second = await client.get("/repos/o/r2")
+            other_lane = await client.post("/graphql")
+            return first, second, other_lane
+    first, second, other_lane = asyncio.run(run())
+    assert first.status_code == second.status_code == other_lane.status_code == 200 # retried after the wait
+    assert [path for path, _ in recorder.sent] == ["/repos/o/r", "/repos/o/r", "/repos/o/r2", "/graphql"]
+    # sleep is faked so the clock doesn't move: the retry and the next rest request both wait out the limit, graphql isn't held back
+    assert len(sleeps) == 2 and all(1.5 < s <= 2 for s in sleeps)
+
+def test_api_lanes():
+    assert gc.AsyncGitHubRateLimitRetryTransport.api(httpx.Request("POST", "https://api.github.com/graphql")) == "graphql"
+    assert gc.AsyncGitHubRateLimitRetryTransport.api(httpx.Request("GET", "https://api.github.com/repos/o/r")) == "rest"
+
+def gql(data: dict | None, errors: list | None = None, status: int = 200, round_trip: float | None = None) -> httpx.Response:
+    body: dict = {"data": data}
+    if errors:
+        body["errors"] = errors
+    return httpx.Response(status, json=body, extensions={"round_trip": round_trip} if round_trip is not None else {})
+
+def rate(cost: int = 1, remaining: int = 5000) -> dict:
+    return {"rateLimit": {"cost": cost, "remaining": remaining, "resetAt": "2030-01-01T00:00:00Z"}}
+
+def test_handle_stores_results_and_grows_fast_batches():
+    batcher = gc.GraphQLBatcher(list("abcd"), batch_size=4)
+    batch = batcher.next_batch()
+    assert batch == [("r0", "a"), ("r1", "b"), ("r2", "c"), ("r3", "d")]
+    rate_limit = batcher.handle(batch, gql({"r0": 0, "r1": 1, "r2": 2, "r3": None} | rate(cost=2)), elapsed=1)
+    assert rate_limit["cost"] == 2
+    assert batcher.results == {0: 0, 1: 1, 2: 2, 3: None}
+    assert batcher.cost_per_item == 0.5
+    assert batcher.batch_size == 7
+    assert batcher.next_batch() is None
+
+def test_handle_sizes_by_round_trip_not_waits():
+    batcher = gc.GraphQLBatcher(list("abcd"), batch_size=4)
+    batch = batcher.next_batch()
+    # 30s including a rate limit wait in the transport, but the query itself was quick
+    batcher.handle(batch, gql({f"r{i}": i for i in range(4)}, round_trip=1), elapsed=30)
+    assert batcher.batch_size > 4
+
+def test_handle_shrinks_slow_batches_towards_target():
+    batcher = gc.GraphQLBatcher(list(range(20)), batch_size=20)
+    batch = batcher.next_batch()
+    batcher.handle(batch, gql({f"r{i}": i for i in range(20)}, round_trip=gc.GITHUB_BATCH_TARGET_SECONDS * 2), elapsed=0)
+    assert batcher.batch_size == 10
+
+def test_failed_batch_is_split_without_counting_attempts():
+    batcher = gc.GraphQLBatcher(list(range(8)), batch_size=8)
+    batch = batcher.next_batch()
+    assert batcher.handle(batch, httpx.Response(502), elapsed=10) == {}
+    assert batcher.batch_size == 4 and batcher.max_batch_size == 7
+    assert not batcher._attempts
+    assert [alias for alias, _ in batcher.next_batch()] == ["r0", "r1", "r2", "r3"]
+
+def test_single_item_gives_up_after_retries():
+    batcher = gc.GraphQLBatcher(["a"], batch_size=1)
+    sent = 0
+    while batch := batcher.next_batch():
+        batcher.handle(batch, None, elapsed=0)
+        sent += 1
+    assert sent == gc.GITHUB_BATCH_RETRIES + 1
+    assert batcher.results == {}
+
+def test_per_item_errors():
+    batcher = gc.GraphQLBatcher(list("abc"), batch_size=3, nested_in=("repository",))
+    batch = batcher.next_batch()
+    errors = [
+        {"type": "NOT_FOUND", "path": ["repository", "r0"], "message": "gone"},
+        {"type": "SERVICE_UNAVAILABLE", "path": ["repository", "r1"], "message": "try again"},
+    ]
+    batcher.handle(batch, gql({"repository": {"r0": None, "r1": None, "r2": "c"}}, errors), elapsed=1)
+    assert batcher.results == {0: None, 2: "c"}
+    assert batcher.next_batch() == [("r1", "b")]
+    assert batcher._attempts == {1: 1}
+
+def test_bad_query_gives_up_at_once():
+    batcher = gc.GraphQLBatcher(list(range(8)), batch_size=8)
+    batch = batcher.next_batch()
+    errors = [{"message": "Parse error on \"}\" (RCURLY) at [1, 10]", "locations": [{"line": 1, "column": 10}]}]
+    batcher.handle(batch, gql(None, errors), elapsed=1)
+    assert batcher.next_batch() is None
+    assert batcher.results == {}
+
+def test_timeout_without_path_is_retried():
+    batcher = gc.GraphQLBatcher(list(range(8)), batch_size=8)
+    batch = batcher.next_batch()
+    errors = [{"message": "Something went wrong while executing your query. This may be the result of a timeout"}]
+    batcher.handle(batch, gql(None, errors), elapsed=10)
+    assert batcher.batch_size == 4
+    assert batcher.next_batch() is not None
+
+def test_batch_size_capped_by_points_left():
+    batcher = gc.GraphQLBatcher(list(range(10)), batch_size=10)
+    batch = batcher.next_batch()
+    batcher.handle(batch, gql({f"r{i}": i for i in range(10)} | rate(cost=10, remaining=3)), elapsed=1)
+    assert batcher.batch_size == 3
+
+def reset_in(seconds: float) -> str:
+    from datetime import UTC, datetime
+    return datetime.fromtimestamp(time.time() + seconds, UTC).isoformat()
+
+def test_budget_tracks_points_in_flight():
+    budget = gc.GraphQLPointBudget()
+    async def run():
+        await budget.reserve(10) # nothing known yet, goes straight out
+        assert budget.in_flight == 10
+        budget.release(10, {"remaining": 100, "resetAt": reset_in(3600)})
+        assert budget.in_flight == 0 and budget.remaining == 100
+        await budget.reserve(60)
+        await asyncio.wait_for(budget.reserve(40), 1) # 100 left covers both
+        assert budget.in_flight == 100
+    asyncio.run(run())
+
+def test_budget_waits_for_reset_when_used_up(monkeypatch):
+    budget = gc.GraphQLPointBudget()
+    budget.release(0, {"remaining": 5, "resetAt": reset_in(3600)})
+    slept = []
+    async def sleep(seconds):
+        slept.append(seconds)
+        budget.reset_at = time.time() # the window resets while waiting
+    monkeypatch.setattr(gc.asyncio, "sleep", sleep)
+    asyncio.run(budget.reserve(10))
+    assert len(slept) == 1 and slept[0] > 3500
+    assert budget.in_flight == 10
+
+def test_budget_keeps_lowest_remaining_of_a_window():
+    budget = gc.GraphQLPointBudget()
+    reset = reset_in(3600)
+    budget.release(0, {"remaining": 50, "resetAt": reset})
+    budget.release(0, {"remaining": 80, "resetAt": reset}) # an older response arriving late
+    assert budget.remaining == 50
+    budget.release(0, {"remaining": 4990, "resetAt": reset_in(7200)}) # next window
+    assert budget.remaining == 4990
+
+def test_failed_query_releases_its_points():
+    budget = gc.GraphQLPointBudget()
+    budget.release(0, {"remaining": 100, "resetAt": reset_in(3600)})
+    async def run():
+        await budget.reserve(30)
+        budget.release(30, {}) # no rateLimit in a failed response
+    asyncio.run(run())
+    assert budget.in_flight == 0 and budget.remaining == 100
@@ -0,0 +1,74 @@
+from unittest.mock import patch
+from pygrister.api import GristApi
+from f.main.grist_mirror import GristMirror, updated_col
+from fakes import SqlGrister
+
+def make_repos(*, with_updated: bool = True, formula: bool = False) -> SqlGrister:
+    cols = [("name", "Text", "")]
+    if with_updated:
+        cols.append((updated_col, "DateTime", "")) # a trigger formula, which grist lists as a data column
+    if formula:
+        cols.append(("shout", "Text", "$name.upper()"))
+    g = SqlGrister("Repos", cols)
+    g.insert(*({"id": i, "name": f"r{i}", **({updated_col: 100 + i} if with_updated else {}), **({"shout": f"R{i}"} if formula else {})} for i in (1, 2, 3)))
+    return g
+
+def names(mirror: GristMirror) -> dict[int, str]:
+    return {rec["id"]: rec["name"] for rec in mirror.iter_records("Repos")}
+
+def test_incremental_sync_fetches_only_changed_rows(tmp_path):
+    g = make_repos()
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"))
+    assert mirror.sync("Repos") == 3
+    g.insert({"id": 2, "name": "renamed", updated_col: 200}, {"id": 4, "name": "r4", updated_col: 200})
+    assert mirror.sync("Repos") == 3 # 2 and 4, plus 3 which has the last timestamp seen before
+    assert names(mirror) == {1: "r1", 2: "renamed", 3: "r3", 4: "r4"}
+
+def test_deletions_only_list_ids_when_the_count_drops(tmp_path):
+    g = make_repos()
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"))
+    mirror.sync("Repos")
+    g.queries.clear()
+    mirror.sync("Repos")
+    assert not any(sql.startswith('SELECT id FROM') for sql, _ in g.queries)
+    # a delete and an add in the same interval still leaves one row too many locally
+    g.db.execute('DELETE FROM "Repos" WHERE id = 1')
+    g.insert({"id": 5, "name": "r5", updated_col: 300})
+    assert names(mirror) == {2: "r2", 3: "r3", 5: "r5"}
+
+def test_table_without_updated_col_is_reread(tmp_path):
+    g = make_repos(with_updated=False)
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"))
+    mirror.sync("Repos")
+    g.insert({"id": 1, "name": "edited"}) # an edit to an existing row, which an id > max_id sync would never see
+    assert mirror.sync("Repos") == 3
+    assert names(mirror)[1] == "edited"
+
+def test_formula_columns_refresh_without_row_edits(tmp_path):
+    g = make_repos(formula=True)
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"))
+    mirror.sync("Repos")
+    g.db.execute('UPDATE "Repos" SET shout = ? WHERE id = 3', ["CHANGED"]) # record_updatedAt untouched
+    g.db.execute('DELETE FROM "Repos" WHERE id = 1')
+    recs = {rec["id"]: rec for rec in mirror.iter_records("Repos")}
+    assert recs.keys() == {2, 3}
+    assert recs[3]["shout"] == "CHANGED" and recs[3]["name"] == "r3"
+
+def test_max_age_skips_grist_until_a_write(tmp_path):
+    g = make_repos()
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"), max_age=3600)
+    g.mirror = mirror
+    mirror.sync("Repos")
+    g.insert({"id": 1, "name": "edited", updated_col: 200})
+    with patch.object(g, "list_cols", side_effect=AssertionError("went to grist")):
+        assert names(mirror)[1] == "r1"
+    with patch.object(GristApi, "apicall", return_value=(200, None)):
+        g.apicall("https://grist.test/api/docs/doc/tables/Repos/records", "PUT")
+    assert names(mirror)[1] == "edited"
+
+def test_column_change_triggers_full_sync(tmp_path):
+    g = make_repos()
+    mirror = GristMirror(g, str(tmp_path / "mirror.sqlite"))
+    mirror.sync("Repos")
+    g.cols[0] = ("name", "Any", "")
+    assert mirror.sync("Repos") == 3
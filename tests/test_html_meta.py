@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+from f.main.html_meta import parse_head
+
+def test_prefers_og_tags():
+    head = b"""<head><title>plain</title><meta property="og:title" content="og">
+        <meta name="description" content="desc"><meta property="og:description" content="og desc">"""
+    assert parse_head(head, "https://site.test") == {"title": "og", "desc": "og desc"}
+
+def test_falls_back_to_title_and_description():
+    head = b'<head><title>plain</title><meta name="description" content="desc">'
+    assert parse_head(head, "https://site.test") == {"title": "plain", "desc": "desc"}
+
+def test_cleans_github_boilerplate():
+    head = b"""<head><title>GitHub - owner/repo: does things</title>
+        <meta name="description" content="Contribute to owner/repo development by creating an account on GitHub.">"""
+    assert parse_head(head, "https://github.com/owner/repo") == {"title": "does things"}
+
+def test_bad_utf8_is_replaced():
+    assert parse_head(b"<title>caf\xe9</title>", "https://site.test") == {"title": "caf�"}
+
+def test_imports_nothing_heavy():
+    # the parse workers load this module, so it mustn't pull in grist, windmill or the http clients
+    code = "import sys, f.main.html_meta; print(sorted(m for m in ('wmill', 'pygrister', 'httpx', 'atproto', 'f.main.ATPTGrister') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert out.stdout.strip() == "[]"
@@ -0,0 +1,24 @@
+import importlib
+import ssl
+import pytest
+import f.main.http_clients as http_clients
+
+@pytest.fixture
+def reload_with_env(monkeypatch):
+    def reload(**env):
+        for var in ("SSL_CERT_FILE", "SSL_CERT_DIR"):
+            monkeypatch.delenv(var, raising=False)
+        for var, value in env.items():
+            monkeypatch.setenv(var, value)
+        return importlib.reload(http_clients)
+    yield reload
+    monkeypatch.undo()
+    importlib.reload(http_clients)
+
+def test_shared_context_by_default(reload_with_env):
+    assert isinstance(reload_with_env().ssl_verify, ssl.SSLContext)
+
+@pytest.mark.parametrize("var", ["SSL_CERT_FILE", "SSL_CERT_DIR"])
+def test_custom_ca_env_is_left_to_httpx(reload_with_env, var):
+    module = reload_with_env(**{var: "/etc/custom-ca"})
+    assert module.ssl_verify is True
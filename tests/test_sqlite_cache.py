@@ -0,0 +1,65 @@
+import os
+from types import SimpleNamespace
+import pytest
+from f.main.sqlite_cache import SqliteCache
+from f.main.identity_cache import IdentityCache
+from f.main.canonical_urls import CanonicalUrlCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("f.main.sqlite_cache.time.time", lambda: now[0])
+    return now
+
+def test_opens_file_on_first_use(tmp_path):
+    cache = SqliteCache(str(tmp_path / "c.sqlite"))
+    assert not os.path.exists(cache.path)
+    assert cache.get("k") == (False, None)
+    assert os.path.exists(cache.path)
+
+def test_round_trips_json_and_persists(tmp_path):
+    path = str(tmp_path / "c.sqlite")
+    SqliteCache(path).set("k", ["etag", {"n": 1}])
+    assert SqliteCache(path).get("k") == (True, ["etag", {"n": 1}])
+
+def test_ttl(tmp_path, clock):
+    cache = SqliteCache(str(tmp_path / "c.sqlite"), ttl=10)
+    cache.set("k", 1)
+    clock[0] += 10
+    assert cache.get("k") == (True, 1)
+    assert cache.items() == {"k": 1}
+    clock[0] += 1
+    assert cache.get("k") == (False, None)
+    assert cache.items() == {}
+
+def test_identity_cache_forgets_failures_sooner(tmp_path, clock):
+    cache = IdentityCache(str(tmp_path / "c.sqlite"), ttl=100, negative_ttl=10)
+    cache.set("did:plc:a", "a.test")
+    cache.set("nobody.test", None)
+    assert cache.get("nobody.test") == (True, None)
+    clock[0] += 50
+    assert cache.get("nobody.test") == (False, None)
+    assert cache.get("did:plc:a") == (True, "a.test")
+
+def test_canonical_url_no_longer_redirecting_is_dropped(tmp_path):
+    cache = CanonicalUrlCache(str(tmp_path / "c.sqlite"))
+    cache.set("https://old.test", "https://new.test")
+    cache.set("https://a.test", "https://b.test")
+    cache.set("https://a.test", "https://a.test")
+    assert cache.redirects() == {"https://old.test": "https://new.test"}
+
+def test_collector_folds_redirects_into_known_rows(tmp_path, monkeypatch):
+    Collector = pytest.importorskip("f.main.Collector")
+    cache = CanonicalUrlCache(str(tmp_path / "c.sqlite"))
+    monkeypatch.setattr(Collector, "canonical_urls", cache)
+    cache.set("https://github.com/old/repo", "https://github.com/new/repo") # renamed repo
+    cache.set("https://site.test", "https://site.test/home") # known site that now redirects
+    cache.set("https://login.test/a", "https://login.test") # neither is a row
+    rows = SimpleNamespace(
+        sites={"https://site.test": {}},
+        repos={"https://github.com/new/repo": {}},
+    )
+    assert Collector.Collector._redirect_alt_urls(rows) == {
+        "https://github.com/old/repo": "https://github.com/new/repo",
+        "https://site.test/home": "https://site.test",
+    }